@@ -61,6 +61,18 @@ class SenderMonitorInterval():
     def as_array(self, features):
         return np.array([self.get(f) / SenderMonitorIntervalMetric.get_by_name(f).scale for f in features])
 
+    # Unscaled values of several features at once, in the order given.
+    # features must be hashable (e.g. a tuple), its metric functions are
+    # looked up once and reused by later calls with the same features.
+    def get_array(self, features):
+        cache = self.features
+        values = []
+        for name, func in _get_metric_funcs(features):
+            if name not in cache:
+                cache[name] = func(self)
+            values.append(cache[name])
+        return np.array(values)
+
     def debug_print(self):
         print('\tflow id: {}, bytes_sent: {}, bytes_acked: {}, bytes_lost: {},\n'
               '\tsend_start_time: {}, send_end_time: {},\n\trecv_start_time: {}, '
@@ -113,6 +125,15 @@ class SenderMonitorIntervalMetric():
     def get_by_name(name):
         return SenderMonitorIntervalMetric._all_metrics[name]
 
+_metric_funcs = {}
+def _get_metric_funcs(features):
+    funcs = _metric_funcs.get(features)
+    if funcs is None:
+        funcs = tuple((name, SenderMonitorIntervalMetric.get_by_name(name).func)
+                      for name in features)
+        _metric_funcs[features] = funcs
+    return funcs
+
 def get_min_obs_vector(feature_names):
     # print("Getting min obs for %s" % feature_names)
     result = []
@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 import json
 import logging
 import os
@@ -5,19 +6,37 @@ import random
 import re
 
 import numpy as np
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def read_json_file(filename):
     """Load json object from a file."""
+    if orjson is not None:
+        with open(filename, 'rb') as f:
+            return orjson.loads(f.read())
     with open(filename, 'r') as f:
         content = json.load(f)
     return content
 
 
-def write_json_file(filename, content):
-    """Dump into a json file."""
+def write_json_file(filename, content, indent=None):
+    """Dump into a json file.
+
+    The output is compact unless indent is given. orjson only indents by 2
+    spaces, so any indent is written with 2 spaces when orjson is used.
+    """
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        with open(filename, 'wb') as f:
+            f.write(orjson.dumps(content, option=option))
+        return
     with open(filename, 'w') as f:
-        json.dump(content, f, indent=4)
+        json.dump(content, f, indent=indent)
 
 
 def set_tf_loglevel(level):
@@ -32,12 +51,16 @@ def set_tf_loglevel(level):
     logging.getLogger('tensorflow').setLevel(level)
 
 
-def natural_sort(l):
-    def convert(text): return int(text) if text.isdigit() else text.lower()
+_NATURAL_SORT_RE = re.compile('([0-9]+)')
+
+
+def natural_sort_key(key):
+    return [int(c) if c.isdigit() else c.lower()
+            for c in _NATURAL_SORT_RE.split(key)]
 
-    def alphanum_key(key): return [convert(c)
-                                   for c in re.split('([0-9]+)', key)]
-    return sorted(l, key=alphanum_key)
+
+def natural_sort(l):
+    return sorted(l, key=natural_sort_key)
 
 
 def set_seed(seed):
@@ -45,16 +68,41 @@ def set_seed(seed):
     np.random.seed(seed)
 
 
+def get_global_rng_state():
+    """Return the state of the random and np.random global generators."""
+    return random.getstate(), np.random.get_state()
+
+
+def set_global_rng_state(state):
+    """Restore a state returned by get_global_rng_state."""
+    random.setstate(state[0])
+    np.random.set_state(state[1])
+
+
+@contextmanager
+def seeded_global_rngs(seed):
+    """Seed random and np.random for the block, then restore their state.
+
+    Code in the block is reproducible without shifting the random streams
+    of the code around it.
+    """
+    state = get_global_rng_state()
+    set_seed(seed)
+    try:
+        yield
+    finally:
+        set_global_rng_state(state)
+
+
 def learnability_objective_function(throughput, delay):
     """Objective function used in https://cs.stanford.edu/~keithw/www/Learnability-SIGCOMM2014.pdf
     throughput: Mbps
     delay: ms
     """
-    score = np.log(throughput) - np.log(delay)
+    score = np.log(np.asarray(throughput)) - np.log(np.asarray(delay))
     # print(throughput, delay, score)
-    score = score.replace([np.inf, -np.inf], np.nan).dropna()
-
-    return score
+    # drop scores of zero throughput or delay
+    return score[np.isfinite(score)]
 
 
 def pcc_aurora_reward(throughput, delay, loss, avg_bw=None, min_rtt=None):
@@ -69,5 +117,16 @@ def pcc_aurora_reward(throughput, delay, loss, avg_bw=None, min_rtt=None):
     return 10 * 50 * throughput/avg_bw - 1000 * delay - 2000 * loss
     # return 10 * throughput - 1000 * delay - 2000 * loss
 
+
+def pcc_aurora_reward_batch(throughput, delay, loss, avg_bw, min_rtt=None):
+    """PCC Aurora reward of many MIs at once.
+    throughput, delay, loss: array-likes with one entry per MI, in the same
+        units as pcc_aurora_reward.
+    """
+    return pcc_aurora_reward(np.asarray(throughput), np.asarray(delay),
+                             np.asarray(loss), avg_bw, min_rtt)
+
+
 def compute_std_of_mean(data):
-    return np.std(data) / np.sqrt(len(data))
+    data = np.asarray(data)
+    return data.std() / np.sqrt(data.size)
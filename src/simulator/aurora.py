@@ -26,7 +26,9 @@ from stable_baselines.results_plotter import load_results, ts2xy
 from simulator import my_heuristic, network
 from simulator.constants import BYTES_PER_PACKET
 from simulator.trace import generate_trace, Trace, generate_traces
-from common.utils import set_tf_loglevel, pcc_aurora_reward
+from common.utils import (
+    get_global_rng_state, pcc_aurora_reward_batch, seeded_global_rngs,
+    set_global_rng_state, set_tf_loglevel)
 from plot_scripts.plot_packet_log import PacketLog
 from udt_plugins.testing.loaded_agent import LoadedModel
 
@@ -36,6 +38,31 @@ if type(tf.contrib) != types.ModuleType:  # if it is LazyLoader
 
 set_tf_loglevel(logging.FATAL)
 
+# initial number of MIs Aurora.test preallocates room for
+TEST_BUFFER_SIZE = 1024
+
+# max number of in-process test episodes sharing one model prediction per MI
+TEST_LOCKSTEP_SIZE = 32
+
+# Aurora.test log files are block buffered
+LOG_FILE_BUFFER_SIZE = 1 << 16
+
+# action taken in Aurora.test before the sender gets any data back
+_ZERO_ACTION = np.array([0])
+_ZERO_ACTION.flags.writeable = False
+
+# directories already created by this process
+_MKDIR_CACHE = set()
+
+# models loaded by test_model in this process
+_CACHED_MODEL = {}
+
+# monitor interval metrics logged by Aurora.test, in unpacking order
+TEST_LOG_METRICS = ('recv rate', 'send rate', 'avg latency', 'loss ratio',
+                    'avg queue delay', 'sent latency inflation',
+                    'latency ratio', 'send ratio', 'recv ratio',
+                    'latency increase', 'conn min latency')
+
 
 class MyMlpPolicy(FeedForwardPolicy):
 
@@ -69,19 +96,26 @@ class SaveOnBestTrainingRewardCallback(BaseCallback):
         # self.save_path = os.path.join(log_dir, 'saved_models')
         self.save_path = log_dir
         self.best_mean_reward = -np.inf
-        self.val_traces = val_traces
+        self.comm = self.aurora.comm
+        self.rank = self.comm.Get_rank()
+        # every rank validates its share of rank 0's validation traces
+        self.val_traces = self.comm.bcast(val_traces, root=0)[
+            self.rank::self.comm.Get_size()]
         self.config_file = config_file
         self.tot_trace_cnt=tot_trace_cnt
         self.update_training_traces_freq = update_training_traces_freq
-        if self.aurora.comm.Get_rank() == 0:
+        if self.rank == 0:
             self.val_log_writer = csv.writer(
                 open(os.path.join(log_dir, 'validation_log.csv'), 'w', 1),
                 delimiter='\t', lineterminator='\n')
             self.val_log_writer.writerow(
                 ['n_calls', 'num_timesteps', 'mean_validation_reward', 'loss',
                  'throughput', 'latency', 'sending_rate', 'tot_t_used(min)'])
+            with self.aurora.model.graph.as_default():
+                self.saver = tf.train.Saver()
         else:
             self.val_log_writer = None
+            self.saver = None
         self.best_val_reward = -np.inf
         self.patience = patience
         self.val_times = 0
@@ -121,46 +155,35 @@ class SaveOnBestTrainingRewardCallback(BaseCallback):
             #             print("Saving new best model to {}".format(self.save_path))
             #         # self.model.save(self.save_path)
 
-            if self.aurora.comm.Get_rank() == 0:
-                with self.model.graph.as_default():
-                    saver = tf.train.Saver()
-                    saver.save(
-                        self.model.sess, os.path.join(
-                            self.save_path, "model_step_{}.ckpt".format(
-                                self.n_calls)))
-                avg_rewards = []
-                avg_losses = []
-                avg_tputs = []
-                avg_delays = []
-                avg_send_rates = []
-                for idx, val_trace in enumerate(self.val_traces):
-                    # print(np.mean(val_trace.bandwidths))
-                    ts_list, val_rewards, loss_list, tput_list, delay_list, \
-                        send_rate_list, action_list, obs_list, mi_list, pkt_log = self.aurora.test(
-                            val_trace, self.log_dir)
-                    # pktlog = PacketLog.from_log(pkt_log)
-                    avg_rewards.append(np.mean(np.array(val_rewards)))
-                    avg_losses.append(np.mean(np.array(loss_list)))
-                    avg_tputs.append(float(np.mean(np.array(tput_list))))
-                    avg_delays.append(np.mean(np.array(delay_list)))
-                    avg_send_rates.append(
-                        float(np.mean(np.array(send_rate_list))))
-                    # avg_rewards.append(pktlog.get_reward())
-                    # avg_losses.append(pktlog.get_loss_rate())
-                    # avg_tputs.append(np.mean(pktlog.get_throughput()[1]))
-                    # avg_delays.append(np.mean(pktlog.get_rtt()[1]))
-                    # avg_send_rates.append(np.mean(pktlog.get_sending_rate()[1]))
-                self.val_log_writer.writerow(
-                    map(lambda t: "%.3f" % t,
-                        [float(self.n_calls), float(self.num_timesteps),
-                         np.mean(np.array(avg_rewards)),
-                         np.mean(np.array(avg_losses)),
-                         np.mean(np.array(avg_tputs)),
-                         np.mean(np.array(avg_delays)),
-                         np.mean(np.array(avg_send_rates)),
-                         (time.time() - self.t_start) / 60]))
+            if self.rank == 0:
+                self.saver.save(self.model.sess, os.path.join(
+                    self.save_path, "model_step_{}.ckpt".format(self.n_calls)))
+            # the live model has the weights just saved, so it is validated
+            # directly. Each rank only tests its share of the traces
+            val_results = validate_model(
+                self.aurora, self.val_traces,
+                self.log_dir) if self.val_traces else []
+            self._log_validation(val_results)
         return True
 
+    def _log_validation(self, val_results):
+        """Gather the validation results of all ranks on rank 0 and log them."""
+        results = self.comm.gather(val_results, root=0)
+        if self.rank != 0:
+            return
+        trace_results = [trace_result for rank_results in results
+                         for trace_result in rank_results]
+        if not trace_results:
+            return
+        avg_rewards, avg_losses, avg_tputs, avg_delays, avg_send_rates = zip(
+            *trace_results)
+        self.val_log_writer.writerow((
+            f"{self.n_calls:.3f}", f"{self.num_timesteps:.3f}",
+            f"{np.mean(avg_rewards):.3f}", f"{np.mean(avg_losses):.3f}",
+            f"{np.mean(avg_tputs):.3f}", f"{np.mean(avg_delays):.3f}",
+            f"{np.mean(avg_send_rates):.3f}",
+            f"{(time.time() - self.t_start) / 60:.3f}"))
+
 
 def save_model_to_serve(model, export_dir):
     if os.path.exists(export_dir):
@@ -205,14 +228,11 @@ class Aurora():
         self.log_dir = log_dir
         self.pretrained_model_path = pretrained_model_path
         self.steps_trained = 0
-        dummy_trace = generate_trace(
-            (10, 10), (2, 2), (50, 50), (0, 0), (100, 100))
-        env = gym.make('PccNs-v0', traces=[dummy_trace],
-                       train_flag=True, delta_scale=self.delta_scale)
+        self.saver = None
         # Load pretrained model
-        # print('create_dummy_env,{}'.format(time.time() - init_start))
         if pretrained_model_path is not None:
             if pretrained_model_path.endswith('.ckpt'):
+                env = self._make_dummy_env()
                 model_create_start = time.time()
                 self.model = PPO1(MyMlpPolicy, env, verbose=1, seed=seed,
                                   optim_stepsize=0.001, schedule='constant',
@@ -223,19 +243,13 @@ class Aurora():
                                   gamma=gamma, tensorboard_log=tensorboard_log, n_cpu_tf_sess=1)
                 # print('create_ppo1,{}'.format(time.time() - model_create_start))
                 tf_restore_start = time.time()
-                with self.model.graph.as_default():
-                    saver = tf.train.Saver()
-                    saver.restore(self.model.sess, pretrained_model_path)
-                try:
-                    self.steps_trained = int(os.path.splitext(
-                        pretrained_model_path)[0].split('_')[-1])
-                except:
-                    self.steps_trained = 0
+                self.reload_checkpoint(pretrained_model_path)
                 # print('tf_restore,{}'.format(time.time()-tf_restore_start))
             else:
                 # model is a tensorflow model to serve
                 self.model = LoadedModel(pretrained_model_path)
         else:
+            env = self._make_dummy_env()
             self.model = PPO1(MyMlpPolicy, env, verbose=1, seed=seed,
                               optim_stepsize=0.001, schedule='constant',
                               timesteps_per_actorbatch=timesteps_per_actorbatch,
@@ -244,11 +258,39 @@ class Aurora():
                               gamma=gamma, tensorboard_log=tensorboard_log, n_cpu_tf_sess=1)
         self.timesteps_per_actorbatch = timesteps_per_actorbatch
 
+    def reload_checkpoint(self, model_path):
+        """Restore the weights of a checkpoint into the existing graph.
+
+        Checkpoints of the same architecture can be swapped in this way
+        without building a new graph and session.
+        """
+        assert isinstance(self.model, PPO1)
+        if self.saver is None:
+            with self.model.graph.as_default():
+                self.saver = tf.train.Saver(var_list=tf.trainable_variables())
+        self.saver.restore(self.model.sess, model_path)
+        self.pretrained_model_path = model_path
+        try:
+            self.steps_trained = int(os.path.splitext(
+                model_path)[0].split('_')[-1])
+        except:
+            self.steps_trained = 0
+
+    def _make_dummy_env(self):
+        """Environment used only to build the PPO1 graph."""
+        dummy_trace = generate_trace(
+            (10, 10), (2, 2), (50, 50), (0, 0), (100, 100))
+        return gym.make('PccNs-v0', traces=[dummy_trace],
+                        train_flag=True, delta_scale=self.delta_scale)
+
     def train(self, config_file,
             # training_traces, validation_traces,
             total_timesteps, tot_trace_cnt,
               tb_log_name=""):
         assert isinstance(self.model, PPO1)
+        # the weights stop matching the restored checkpoint from here on, so
+        # test_on_traces must not send its path to worker processes
+        self.pretrained_model_path = None
 
         training_traces = generate_traces(config_file, tot_trace_cnt,
                                           duration=30, constant_bw=False)
@@ -270,32 +312,48 @@ class Aurora():
         self.model.learn(total_timesteps=total_timesteps,
                          tb_log_name=tb_log_name, callback=callback)
 
-    def test_on_traces(self, traces: List[Trace], save_dirs: List[str]):
+    def test_on_traces(self, traces: List[Trace], save_dirs: List[str],
+                       n_proc=None):
+        """Test on every trace and return the results and packet logs.
+
+        The traces are tested in this process unless n_proc > 1 is given, in
+        which case n_proc spawned workers each restore the model from
+        pretrained_model_path. That is only done while the model still holds
+        the weights of that checkpoint.
+
+        As in Aurora.test, every episode runs on the global random
+        generators seeded with self.seed. Results are reproducible but differ
+        from versions that used the caller's random state.
+        """
+        assert len(traces) == len(save_dirs)
+        if (n_proc is None or n_proc <= 1 or len(traces) <= 1 or
+                self.pretrained_model_path is None):
+            # a model which only lives in this process cannot be shipped to
+            # workers, and a single trace is not worth a pool
+            test_outputs = []
+            for i in range(0, len(traces), TEST_LOCKSTEP_SIZE):
+                test_outputs += self.test_in_lockstep(
+                    traces[i:i + TEST_LOCKSTEP_SIZE],
+                    save_dirs[i:i + TEST_LOCKSTEP_SIZE])
+        else:
+            arguments = [(self.pretrained_model_path, trace, save_dir,
+                          self.seed, self.delta_scale)
+                         for trace, save_dir in zip(traces, save_dirs)]
+            # spawn instead of fork since tensorflow state is not fork-safe
+            with mp.get_context('spawn').Pool(processes=n_proc) as pool:
+                test_outputs = pool.starmap(
+                    test_model, arguments,
+                    chunksize=max(1, len(arguments) // (4 * n_proc)))
         results = []
         pkt_logs = []
-        for trace, save_dir in zip(traces, save_dirs):
-            ts_list, reward_list, loss_list, tput_list, delay_list, \
-                send_rate_list, action_list, obs_list, mi_list, pkt_log = self.test(
-                    trace, save_dir)
+        for ts_list, reward_list, loss_list, tput_list, delay_list, \
+                send_rate_list, action_list, obs_list, mi_list, pkt_log in test_outputs:
             result = list(zip(ts_list, reward_list, send_rate_list, tput_list,
                               delay_list, loss_list, action_list, obs_list, mi_list))
             pkt_logs.append(pkt_log)
             results.append(result)
         return results, pkt_logs
 
-        # results = []
-        # pkt_logs = []
-        # n_proc=mp.cpu_count()//2
-        # arguments = [(self.pretrained_model_path, trace, save_dir, self.seed) for trace, save_dir in zip(traces, save_dirs)]
-        # with mp.Pool(processes=n_proc) as pool:
-        #     for ts_list, reward_list, loss_list, tput_list, delay_list, \
-        #             send_rate_list, action_list, obs_list, mi_list, pkt_log  in pool.starmap(test_model, arguments):
-        #         result = list(zip(ts_list, reward_list, send_rate_list, tput_list,
-        #                           delay_list, loss_list, action_list, obs_list, mi_list))
-        #         pkt_logs.append(pkt_log)
-        #         results.append(result)
-        # return results, pkt_logs
-
         # results = []
         # pkt_logs = []
         # with MPIPoolExecutor(max_workers=4) as executor:
@@ -335,120 +393,256 @@ class Aurora():
     def load_model(self):
         raise NotImplementedError
 
-    def test(self, trace: Trace, save_dir: str):
-        reward_list = []
-        loss_list = []
-        tput_list = []
-        delay_list = []
-        send_rate_list = []
-        ts_list = []
-        action_list = []
-        mi_list = []
-        obs_list = []
-        os.makedirs(save_dir, exist_ok=True)
-        with open(os.path.join(save_dir, 'aurora_simulation_log.csv'), 'w', 1) as f:
-            writer = csv.writer(f, lineterminator='\n')
-            writer.writerow(['timestamp', "target_send_rate", "send_rate",
-                             'recv_rate', 'max_recv_rate', 'latency',
-                             'loss', 'reward', "action", "bytes_sent",
-                             "bytes_acked", "bytes_lost", "MI",
-                             "send_start_time",
-                             "send_end_time", 'recv_start_time',
-                             'recv_end_time', 'latency_increase',
-                             "packet_size", 'min_lat', 'sent_latency_inflation',
-                             'latency_ratio', 'send_ratio',
-                             'bandwidth', "queue_delay",
-                             'packet_in_queue', 'queue_size', 'cwnd',
-                             'ssthresh', "rto", "recv_ratio"])
-            env = gym.make(
-                'PccNs-v0', traces=[trace], delta_scale=self.delta_scale)
-            env.seed(self.seed)
-            obs = env.reset()
-            # print(obs)
-            # heuristic = my_heuristic.MyHeuristic()
-            while True:
-                pred_start = time.time()
-                if isinstance(self.model, LoadedModel):
-                    obs = obs.reshape(1, -1)
-                    action = self.model.act(obs)
-                    action = action['act'][0]
+    def test(self, trace: Trace, save_dir: str, write_log: bool = True):
+        """Test on one trace.
+
+        The global random and np.random generators are seeded with self.seed
+        for the episode and restored afterwards, so the result no longer
+        depends on the random state the caller set up.
+        """
+        return self.test_in_lockstep([trace], [save_dir], write_log)[0]
+
+    def test_in_lockstep(self, traces: List[Trace], save_dirs: List[str],
+                         write_log: bool = True):
+        """Test on several traces side by side in this process.
+
+        All episodes advance one MI at a time, so the model is evaluated once
+        per MI on the stacked observations of every unfinished episode.
+        Returns the output of Aurora.test for each trace.
+
+        The simulator draws from the global random and np.random generators.
+        Every episode starts from those generators seeded with self.seed and
+        keeps its own copy of their state while the others run, so a trace
+        gives the same result whichever traces it is tested with. The
+        generators are restored to the caller's state on return.
+        """
+        assert len(traces) == len(save_dirs)
+        outputs = [None] * len(traces)
+        episodes = {}
+        obs = {}
+        # random states of the episodes not currently running. The state is
+        # only swapped when another episode runs, never for a single trace
+        rng_states = {}
+        with seeded_global_rngs(self.seed):
+            start_rng_state = None
+            current = None  # episode whose state the global generators hold
+            for idx, (trace, save_dir) in enumerate(zip(traces, save_dirs)):
+                if current is None:
+                    if len(traces) > 1:
+                        start_rng_state = get_global_rng_state()
                 else:
-                    if env.net.senders[0].got_data:
-                        action, _states = self.model.predict(
-                            obs, deterministic=True)
-                    else:
-                        action = np.array([0])
-                # print("pred,{}".format(time.time() - pred_start))
-                # print(env.senders[0].rate * 1500 * 8 / 1e6)
-
-                # get the new MI and stats collected in the MI
-                # sender_mi = env.senders[0].get_run_data()
-                sender_mi = env.senders[0].history.back() #get_run_data()
-                # if env.net.senders[0].got_data:
-                #     action = heuristic.step(obs, sender_mi)
-                #     # action = my_heuristic.stateless_step(env.senders[0].send_rate,
-                #     #         env.senders[0].avg_latency, env.senders[0].lat_diff, env.senders[0].start_stage,
-                #     #         env.senders[0].max_tput, env.senders[0].min_rtt, sender_mi.rtt_samples[-1])
-                #     # action = my_heuristic.stateless_step(*obs)
-                # else:
-                #     action = np.array([0])
-                # max_recv_rate = heuristic.max_tput
-                max_recv_rate = env.senders[0].max_tput
-                throughput = sender_mi.get("recv rate")  # bits/sec
-                send_rate = sender_mi.get("send rate")  # bits/sec
-                latency = sender_mi.get("avg latency")
-                loss = sender_mi.get("loss ratio")
-                avg_queue_delay = sender_mi.get('avg queue delay')
-                sent_latency_inflation = sender_mi.get('sent latency inflation')
-                latency_ratio = sender_mi.get('latency ratio')
-                send_ratio = sender_mi.get('send ratio')
-                recv_ratio = sender_mi.get('recv ratio')
-                reward = pcc_aurora_reward(
-                    throughput / 8 / BYTES_PER_PACKET, latency, loss,
-                    np.mean(trace.bandwidths) * 1e6 / 8 / BYTES_PER_PACKET, np.mean(trace.delays) * 2/ 1e3)
-
-                writer.writerow([
-                    env.net.get_cur_time(), round(env.senders[0].rate * BYTES_PER_PACKET * 8, 0),
+                    if current in episodes:
+                        rng_states[current] = get_global_rng_state()
+                    set_global_rng_state(start_rng_state)
+                current = idx
+                episode = self._test_episode(trace, save_dir, write_log)
+                try:
+                    obs[idx] = next(episode)
+                    episodes[idx] = episode
+                except StopIteration as stop:
+                    outputs[idx] = stop.value
+            while episodes:
+                idxs = list(episodes)
+                actions = self._predict(np.stack([obs[idx] for idx in idxs]))
+                for idx, action in zip(idxs, actions):
+                    if idx != current:
+                        if current in episodes:
+                            rng_states[current] = get_global_rng_state()
+                        set_global_rng_state(rng_states.pop(idx))
+                        current = idx
+                    try:
+                        obs[idx] = episodes[idx].send(action)
+                    except StopIteration as stop:
+                        outputs[idx] = stop.value
+                        del episodes[idx]
+        return outputs
+
+    def _predict(self, obs):
+        """Return deterministic actions for a batch of observations."""
+        if isinstance(self.model, LoadedModel):
+            return self.model.act(obs)['act']
+        action, _states = self.model.predict(obs, deterministic=True)
+        return action
+
+    def _test_episode(self, trace: Trace, save_dir: str,
+                      write_log: bool = True):
+        """Generator running one test episode.
+
+        Yields an observation whenever an action from the model is needed and
+        expects the action to be sent back. Returns the test results. The
+        simulation and packet logs are only written to save_dir if write_log
+        is set.
+        """
+        # per-MI results are stored column-wise and grown on demand
+        capacity = TEST_BUFFER_SIZE
+        ts_arr = np.empty(capacity)
+        loss_arr = np.empty(capacity)
+        tput_arr = np.empty(capacity)
+        delay_arr = np.empty(capacity)
+        send_rate_arr = np.empty(capacity)
+        action_arr = np.empty(capacity)
+        mi_arr = np.empty(capacity)
+        step = 0
+        if write_log and save_dir not in _MKDIR_CACHE:
+            os.makedirs(save_dir, exist_ok=True)
+            _MKDIR_CACHE.add(save_dir)
+        env = gym.make(
+            'PccNs-v0', traces=[trace], delta_scale=self.delta_scale)
+        env.seed(self.seed)
+        obs = env.reset()
+        obs_arr = np.empty((capacity, obs.size), dtype=obs.dtype)
+        # env.reset() rebuilds the network, so bind it afterwards
+        net = env.net
+        sender = env.senders[0]
+        link = env.links[0]
+        avg_bw = trace.mean_bandwidth * 1e6 / 8 / BYTES_PER_PACKET
+        min_rtt = trace.mean_delay * 2 / 1e3
+        # print(obs)
+        # heuristic = my_heuristic.MyHeuristic()
+        log_rows = []
+        while True:
+            if isinstance(self.model, LoadedModel) or sender.got_data:
+                action = yield obs
+            else:
+                action = _ZERO_ACTION
+            # print(env.senders[0].rate * 1500 * 8 / 1e6)
+
+            # get the new MI and stats collected in the MI
+            # sender_mi = env.senders[0].get_run_data()
+            sender_mi = sender.history.back() #get_run_data()
+            # if env.net.senders[0].got_data:
+            #     action = heuristic.step(obs, sender_mi)
+            #     # action = my_heuristic.stateless_step(env.senders[0].send_rate,
+            #     #         env.senders[0].avg_latency, env.senders[0].lat_diff, env.senders[0].start_stage,
+            #     #         env.senders[0].max_tput, env.senders[0].min_rtt, sender_mi.rtt_samples[-1])
+            #     # action = my_heuristic.stateless_step(*obs)
+            # else:
+            #     action = np.array([0])
+            # max_recv_rate = heuristic.max_tput
+            max_recv_rate = sender.max_tput
+            # throughput and send_rate are in bits/sec
+            (throughput, send_rate, latency, loss, avg_queue_delay,
+             sent_latency_inflation, latency_ratio, send_ratio, recv_ratio,
+             latency_increase, conn_min_latency) = sender_mi.get_array(
+                 TEST_LOG_METRICS)
+            cur_time = net.get_cur_time()
+
+            if write_log:
+                log_rows.append([
+                    cur_time, round(sender.rate * BYTES_PER_PACKET * 8, 0),
                     round(send_rate, 0), round(throughput, 0), round(max_recv_rate), latency, loss,
-                    reward, action.item(), sender_mi.bytes_sent, sender_mi.bytes_acked,
+                    None, action.item(), sender_mi.bytes_sent, sender_mi.bytes_acked,
                     sender_mi.bytes_lost, sender_mi.send_end - sender_mi.send_start,
                     sender_mi.send_start, sender_mi.send_end,
                     sender_mi.recv_start, sender_mi.recv_end,
-                    sender_mi.get('latency increase'), sender_mi.packet_size,
-                    sender_mi.get('conn min latency'), sent_latency_inflation,
+                    latency_increase, sender_mi.packet_size,
+                    conn_min_latency, sent_latency_inflation,
                     latency_ratio, send_ratio,
-                    env.links[0].get_bandwidth(
-                        env.net.get_cur_time()) * BYTES_PER_PACKET * 8,
-                    avg_queue_delay, env.links[0].pkt_in_queue, env.links[0].queue_size,
-                    env.senders[0].cwnd, env.senders[0].ssthresh, env.senders[0].rto, recv_ratio])
-                reward_list.append(reward)
-                loss_list.append(loss)
-                delay_list.append(latency * 1000)
-                tput_list.append(throughput / 1e6)
-                send_rate_list.append(send_rate / 1e6)
-                ts_list.append(env.net.get_cur_time())
-                action_list.append(action.item())
-                mi_list.append(sender_mi.send_end - sender_mi.send_start)
-                obs_list.append(obs.tolist())
-                step_start = time.time()
-                obs, rewards, dones, info = env.step(action)
-                # print("step,{}".format(time.time() - step_start))
-
-                if dones:
-                    break
-        with open(os.path.join(save_dir, "aurora_packet_log.csv"), 'w', 1) as f:
-            pkt_logger = csv.writer(f, lineterminator='\n')
-            pkt_logger.writerow(['timestamp', 'packet_event_id', 'event_type',
-                                 'bytes', 'cur_latency', 'queue_delay',
-                                 'packet_in_queue', 'sending_rate', 'bandwidth'])
-            pkt_logger.writerows(env.net.pkt_log)
-        return ts_list, reward_list, loss_list, tput_list, delay_list, send_rate_list, action_list, obs_list, mi_list, env.net.pkt_log
-
-def test_model(model_path: str, trace: Trace, save_dir: str, seed: int):
-    model = Aurora(seed, "", 10, model_path)
-    pid = os.getpid()
-    # print(pid, 'create model')
-
-    # ret = model.test(trace, save_dir)
-    print(pid, 'return')
-    return ret
+                    link.get_bandwidth(cur_time) * BYTES_PER_PACKET * 8,
+                    avg_queue_delay, link.pkt_in_queue, link.queue_size,
+                    sender.cwnd, sender.ssthresh, sender.rto, recv_ratio])
+            if step == capacity:
+                capacity *= 2
+                ts_arr, loss_arr, tput_arr, delay_arr, send_rate_arr, \
+                    action_arr, mi_arr = [
+                        np.resize(arr, capacity) for arr in (
+                            ts_arr, loss_arr, tput_arr, delay_arr,
+                            send_rate_arr, action_arr, mi_arr)]
+                obs_arr = np.resize(obs_arr, (capacity, obs_arr.shape[1]))
+            ts_arr[step] = cur_time
+            loss_arr[step] = loss
+            tput_arr[step] = throughput
+            delay_arr[step] = latency
+            send_rate_arr[step] = send_rate
+            action_arr[step] = action.item()
+            mi_arr[step] = sender_mi.send_end - sender_mi.send_start
+            obs_arr[step] = obs
+            step += 1
+            obs, rewards, dones, info = env.step(action)
+
+            if dones:
+                break
+        # rewards of the whole episode are computed in one pass and filled
+        # into the reward column of the log
+        reward_arr = pcc_aurora_reward_batch(
+            tput_arr[:step] / 8 / BYTES_PER_PACKET, delay_arr[:step],
+            loss_arr[:step], avg_bw, min_rtt)
+        pkt_log = net.pkt_log
+        if write_log:
+            for row, reward in zip(log_rows, reward_arr):
+                row[7] = reward
+            with open(os.path.join(save_dir, 'aurora_simulation_log.csv'), 'w',
+                      LOG_FILE_BUFFER_SIZE) as f:
+                writer = csv.writer(f, lineterminator='\n')
+                writer.writerow(['timestamp', "target_send_rate", "send_rate",
+                                 'recv_rate', 'max_recv_rate', 'latency',
+                                 'loss', 'reward', "action", "bytes_sent",
+                                 "bytes_acked", "bytes_lost", "MI",
+                                 "send_start_time",
+                                 "send_end_time", 'recv_start_time',
+                                 'recv_end_time', 'latency_increase',
+                                 "packet_size", 'min_lat', 'sent_latency_inflation',
+                                 'latency_ratio', 'send_ratio',
+                                 'bandwidth', "queue_delay",
+                                 'packet_in_queue', 'queue_size', 'cwnd',
+                                 'ssthresh', "rto", "recv_ratio"])
+                writer.writerows(log_rows)
+            with open(os.path.join(save_dir, "aurora_packet_log.csv"), 'w',
+                      LOG_FILE_BUFFER_SIZE) as f:
+                pkt_logger = csv.writer(f, lineterminator='\n')
+                pkt_logger.writerow(['timestamp', 'packet_event_id', 'event_type',
+                                     'bytes', 'cur_latency', 'queue_delay',
+                                     'packet_in_queue', 'sending_rate', 'bandwidth'])
+                pkt_logger.writerows(pkt_log)
+        ts_list = ts_arr[:step].tolist()
+        reward_list = reward_arr.tolist()
+        loss_list = loss_arr[:step].tolist()
+        tput_list = (tput_arr[:step] / 1e6).tolist()
+        delay_list = (delay_arr[:step] * 1000).tolist()
+        send_rate_list = (send_rate_arr[:step] / 1e6).tolist()
+        action_list = action_arr[:step].tolist()
+        mi_list = mi_arr[:step].tolist()
+        obs_list = obs_arr[:step].tolist()
+        return ts_list, reward_list, loss_list, tput_list, delay_list, send_rate_list, action_list, obs_list, mi_list, pkt_log
+
+def validate_model(model: Aurora, traces: List[Trace], log_dir: str):
+    """Test a model on validation traces.
+
+    Return a (reward, loss, throughput, latency, sending rate) tuple of
+    per-trace averages for each trace.
+    """
+    avg_rewards = []
+    avg_losses = []
+    avg_tputs = []
+    avg_delays = []
+    avg_send_rates = []
+    test_outputs = []
+    for i in range(0, len(traces), TEST_LOCKSTEP_SIZE):
+        batch = traces[i:i + TEST_LOCKSTEP_SIZE]
+        test_outputs += model.test_in_lockstep(
+            batch, [log_dir] * len(batch), write_log=False)
+    for ts_list, val_rewards, loss_list, tput_list, delay_list, \
+            send_rate_list, action_list, obs_list, mi_list, pkt_log in test_outputs:
+        # pktlog = PacketLog.from_log(pkt_log)
+        avg_rewards.append(float(np.mean(val_rewards)))
+        avg_losses.append(float(np.mean(loss_list)))
+        avg_tputs.append(float(np.mean(tput_list)))
+        avg_delays.append(float(np.mean(delay_list)))
+        avg_send_rates.append(float(np.mean(send_rate_list)))
+        # avg_rewards.append(pktlog.get_reward())
+        # avg_losses.append(pktlog.get_loss_rate())
+        # avg_tputs.append(np.mean(pktlog.get_throughput()[1]))
+        # avg_delays.append(np.mean(pktlog.get_rtt()[1]))
+        # avg_send_rates.append(np.mean(pktlog.get_sending_rate()[1]))
+    return list(zip(avg_rewards, avg_losses, avg_tputs, avg_delays,
+                    avg_send_rates))
+
+
+def test_model(model_path: str, trace: Trace, save_dir: str, seed: int,
+               delta_scale: float = 1):
+    # pool workers test many traces, so the model is only restored once
+    key = (model_path, seed, delta_scale)
+    if key not in _CACHED_MODEL:
+        _CACHED_MODEL[key] = Aurora(seed, "", 10, model_path,
+                                    delta_scale=delta_scale)
+    return _CACHED_MODEL[key].test(trace, save_dir)
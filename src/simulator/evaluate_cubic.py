@@ -61,10 +61,15 @@ def test_on_trace(trace, save_dir, seed):
 
 
 def test_on_traces(traces, save_dirs, seed):
-    n_proc=mp.cpu_count()//2
     arguments = [(trace, save_dir, seed) for trace, save_dir in zip(traces, save_dirs)]
-    with mp.Pool(processes=n_proc) as pool:
-        results = pool.starmap(test_on_trace, arguments)
+    # every trace is an independent simulation, one task per trace keeps the
+    # workers balanced; a single trace is not worth a pool
+    n_proc = min(max(1, mp.cpu_count() // 2), len(arguments))
+    if n_proc <= 1:
+        results = [test_on_trace(*argument) for argument in arguments]
+    else:
+        with mp.Pool(processes=n_proc) as pool:
+            results = pool.starmap(test_on_trace, arguments, chunksize=1)
     rewards = [result[0] for result in results]
     pkt_logs = [result[1] for result in results]
     # rewards = []
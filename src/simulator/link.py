@@ -35,11 +35,29 @@ class Link():
         # print('queue delay: ', q_delay)
         return self.trace.get_delay(event_time) / 1000.0 + q_delay
 
-    def packet_enters_link(self, event_time):
+    def get_cur_latency_queue_delay_and_bw(self, event_time):
+        """Return latency (s), queue delay (s) and bandwidth (pkts/s).
+
+        Same values as get_cur_latency, get_cur_queue_delay and
+        get_bandwidth, with one queue update and one trace lookup.
+        """
+        q_delay = self.get_cur_queue_delay(event_time)
+        bw, delay = self.trace.get_bw_delay(event_time)
+        return (delay / 1000.0 + q_delay, q_delay,
+                bw * 1e6 / 8 / BYTES_PER_PACKET)
+
+    def packet_enters_link(self, event_time, bandwidth=None):
+        """Try to enqueue a packet at event_time.
+
+        bandwidth is an optional, precomputed link bandwidth in pkts/s, as
+        returned by get_bandwidth(event_time). It is looked up if None.
+        """
         if (random.random() < self.trace.get_loss_rate()):
             return False
         self.queue_delay = self.get_cur_queue_delay(event_time)
-        extra_delay = 1.0 / self.get_bandwidth(event_time)
+        if bandwidth is None:
+            bandwidth = self.get_bandwidth(event_time)
+        extra_delay = 1.0 / bandwidth
         # if 1 + math.ceil(self.pkt_in_queue) > self.queue_size:
         #     return False
         if 1 + self.pkt_in_queue > self.queue_size:
@@ -11,6 +11,8 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from collections import deque
+import functools
 import heapq
 import os
 import random
@@ -43,6 +45,18 @@ MAX_LATENCY_NOISE = 1.1
 # DEBUG = True
 DEBUG = False
 
+# packet log events, stored in Network's packet log by their index
+PKT_EVENT_TYPES = ('lost', 'acked', 'arrived', 'sent')
+PKT_EVENT_LOST, PKT_EVENT_ACKED, PKT_EVENT_ARRIVED, PKT_EVENT_SENT = range(4)
+PKT_LOG_COLUMNS = ['timestamp', 'packet_event_id', 'event_type', 'bytes',
+                   'cur_latency', 'queue_delay', 'packet_in_queue',
+                   'sending_rate', 'bandwidth']
+PKT_LOG_CAPACITY = 1 << 16
+# initial size of the buffer of per-packet send delays in run_for_dur
+EXTRA_DELAYS_CAPACITY = 1 << 10
+# initial size of the per-MI sample buffers of a Sender
+SAMPLE_BUFFER_CAPACITY = 1 << 10
+
 
 def debug_print(msg):
     if DEBUG:
@@ -73,6 +87,8 @@ class EmuReplay:
 class Network():
 
     def __init__(self, senders, links, env):
+        # run_for_dur is written for the single sender the environment creates
+        assert len(senders) == 1, "Network supports exactly one sender."
         self.event_count = 0
         self.q = []
         self.cur_time = 0.0
@@ -81,45 +97,129 @@ class Network():
         self.queue_initial_packets()
         self.env = env
 
-        self.pkt_log = []
+        self._reset_pkt_log()
+        self._extra_delays = np.empty(EXTRA_DELAYS_CAPACITY)
 
-        self.recv_rate_cache = []
+        # receiving rates of the last 6 MIs
+        self.recv_rate_cache = deque(maxlen=6)
 
     def queue_initial_packets(self):
+        # events all belong to the single sender, so they do not refer to it.
+        # Events are ordered by time and then by packet event id. A packet
+        # has at most one event in the queue, so the id is unique there and
+        # the remaining fields are never compared.
         for sender in self.senders:
             sender.register_network(self)
             sender.reset_obs()
-            heapq.heappush(self.q, (0, sender, EVENT_TYPE_SEND,
-                                    0, 0.0, False, self.event_count, sender.rto, 0))
+            heapq.heappush(self.q, (0, self.event_count, EVENT_TYPE_SEND,
+                                    0, 0.0, False, sender.rto, 0))
             self.event_count += 1
 
+    def _reset_pkt_log(self):
+        # packet events are logged column-wise and the columns are grown on
+        # demand
+        self._log_n = 0
+        self._log_ts = np.empty(PKT_LOG_CAPACITY)
+        self._log_event_id = np.empty(PKT_LOG_CAPACITY, dtype=np.int64)
+        self._log_type = np.empty(PKT_LOG_CAPACITY, dtype=np.uint8)
+        self._log_latency = np.empty(PKT_LOG_CAPACITY)
+        self._log_queue_delay = np.empty(PKT_LOG_CAPACITY)
+        self._log_pkt_in_queue = np.empty(PKT_LOG_CAPACITY)
+        self._log_rate = np.empty(PKT_LOG_CAPACITY)
+        self._log_bw = np.empty(PKT_LOG_CAPACITY)
+
+    def _log_packet(self, event_id, pkt_event, cur_latency, event_queue_delay,
+                    sender):
+        i = self._log_n
+        if i == self._log_ts.shape[0]:
+            self._log_ts, self._log_event_id, self._log_type, \
+                self._log_latency, self._log_queue_delay, \
+                self._log_pkt_in_queue, self._log_rate, self._log_bw = [
+                    np.resize(arr, 2 * i) for arr in (
+                        self._log_ts, self._log_event_id, self._log_type,
+                        self._log_latency, self._log_queue_delay,
+                        self._log_pkt_in_queue, self._log_rate, self._log_bw)]
+        self._log_ts[i] = self.cur_time
+        self._log_event_id[i] = event_id
+        self._log_type[i] = pkt_event
+        self._log_latency[i] = cur_latency
+        self._log_queue_delay[i] = event_queue_delay
+        self._log_pkt_in_queue[i] = self.links[0].pkt_in_queue
+        self._log_rate[i] = sender.rate * BYTES_PER_PACKET * 8
+        self._log_bw[i] = self.links[0].get_bandwidth(
+            self.cur_time) * BYTES_PER_PACKET * 8
+        self._log_n = i + 1
+
+    @property
+    def pkt_log(self):
+        """Packet log as a list of rows in PKT_LOG_COLUMNS order."""
+        n = self._log_n
+        return [[ts, event_id, PKT_EVENT_TYPES[pkt_event], BYTES_PER_PACKET,
+                 latency, queue_delay, pkt_in_queue, rate, bw]
+                for ts, event_id, pkt_event, latency, queue_delay,
+                pkt_in_queue, rate, bw in zip(
+                    self._log_ts[:n].tolist(), self._log_event_id[:n].tolist(),
+                    self._log_type[:n].tolist(), self._log_latency[:n].tolist(),
+                    self._log_queue_delay[:n].tolist(),
+                    self._log_pkt_in_queue[:n].tolist(),
+                    self._log_rate[:n].tolist(), self._log_bw[:n].tolist())]
+
+    def pkt_log_as_dataframe(self):
+        n = self._log_n
+        return pd.DataFrame({
+            'timestamp': self._log_ts[:n],
+            'packet_event_id': self._log_event_id[:n],
+            'event_type': np.array(PKT_EVENT_TYPES)[self._log_type[:n]],
+            'bytes': np.full(n, BYTES_PER_PACKET),
+            'cur_latency': self._log_latency[:n],
+            'queue_delay': self._log_queue_delay[:n],
+            'packet_in_queue': self._log_pkt_in_queue[:n],
+            'sending_rate': self._log_rate[:n],
+            'bandwidth': self._log_bw[:n]}, columns=PKT_LOG_COLUMNS)
+
     def reset(self):
-        self.pkt_log = []
+        self._reset_pkt_log()
         self.cur_time = 0.0
         self.q = []
-        [link.reset() for link in self.links]
-        [sender.reset() for sender in self.senders]
+        for link in self.links:
+            link.reset()
+        for sender in self.senders:
+            sender.reset()
         self.queue_initial_packets()
-        self.recv_rate_cache = []
+        self.recv_rate_cache = deque(maxlen=6)
 
     def get_cur_time(self):
         return self.cur_time
 
     def run_for_dur(self, dur, action=None):
-        if self.senders[0].lat_diff != 0:
-            self.senders[0].start_stage = False
+        sender = self.senders[0]
+        if sender.lat_diff != 0:
+            sender.start_stage = False
         start_time = self.cur_time
         end_time = min(self.cur_time + dur,
                        self.env.current_trace.timestamps[-1])
         debug_print('MI from {} to {}, dur {}'.format(
             self.cur_time, end_time, dur))
-        for sender in self.senders:
-            sender.reset_obs()
+        sender.reset_obs()
         # set_obs_start = False
-        extra_delays = []  # time used to put packet onto the network
+        # time used to put packet onto the network, reusing the buffer of
+        # earlier calls
+        extra_delays = self._extra_delays
+        n_extra_delays = 0
+        # bind attributes and functions used on every event to locals
+        q = self.q
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        link0 = self.links[0]
+        path = sender.path
+        path_len = len(path)
+        dest = sender.dest
+        event_count = self.event_count
+        # packets are only logged outside of training
+        log_packets = not self.env.train_flag
         while True:
-            event_time, sender, event_type, next_hop, cur_latency, dropped, \
-                event_id, rto, event_queue_delay = self.q[0]
+            event_time, event_id, event_type, next_hop, cur_latency, \
+                dropped, rto, event_queue_delay = q[0]
             # if not sender.got_data and event_time >= end_time and event_type == EVENT_TYPE_ACK and next_hop == len(sender.path):
             #     end_time = event_time
             #     self.cur_time = end_time
@@ -129,8 +229,7 @@ class Network():
                 end_time = event_time
                 self.cur_time = end_time
                 break
-            event_time, sender, event_type, next_hop, cur_latency, dropped, \
-                event_id, rto, event_queue_delay = heapq.heappop(self.q)
+            heappop(q)
             self.cur_time = event_time
             new_event_time = event_time
             new_event_type = event_type
@@ -139,19 +238,21 @@ class Network():
             new_dropped = dropped
             new_event_queue_delay = event_queue_delay
             push_new_event = False
-            debug_print("Got %d event %s, to link %d, latency %f at time %f, "
-                        "next_hop %d, dropped %s, event_q length %f, "
-                        "sender rate %f, duration: %f, queue_size: %f, "
-                        "rto: %f, cwnd: %f, ssthresh: %f, sender rto %f, "
-                        "pkt in flight %d, wait time %d" % (
-                            event_id, event_type, next_hop, cur_latency,
-                            event_time, next_hop, dropped, len(self.q),
-                            sender.rate, dur, self.links[0].queue_size,
-                            rto, sender.cwnd, sender.ssthresh, sender.rto,
-                            int(sender.bytes_in_flight/BYTES_PER_PACKET),
-                            sender.pkt_loss_wait_time))
+            # only format the message when it is printed
+            if DEBUG:
+                debug_print("Got %d event %s, to link %d, latency %f at time %f, "
+                            "next_hop %d, dropped %s, event_q length %f, "
+                            "sender rate %f, duration: %f, queue_size: %f, "
+                            "rto: %f, cwnd: %f, ssthresh: %f, sender rto %f, "
+                            "pkt in flight %d, wait time %d" % (
+                                event_id, event_type, next_hop, cur_latency,
+                                event_time, next_hop, dropped, len(q),
+                                sender.rate, dur, link0.queue_size,
+                                rto, sender.cwnd, sender.ssthresh, sender.rto,
+                                int(sender.bytes_in_flight/BYTES_PER_PACKET),
+                                sender.pkt_loss_wait_time))
             if event_type == EVENT_TYPE_ACK:
-                if next_hop == len(sender.path):
+                if next_hop == path_len:
                     # if cur_latency > 1.0:
                     #     sender.timeout(cur_latency)
                     # sender.on_packet_lost(cur_latency)
@@ -161,73 +262,57 @@ class Network():
                         new_dropped = True
                     elif dropped:
                         sender.on_packet_lost(cur_latency)
-                        if not self.env.train_flag:
-                            self.pkt_log.append(
-                                [self.cur_time, event_id, 'lost',
-                                 BYTES_PER_PACKET, cur_latency, event_queue_delay,
-                                 self.links[0].pkt_in_queue,
-                                 sender.rate * BYTES_PER_PACKET * 8,
-                                 self.links[0].get_bandwidth(self.cur_time) * BYTES_PER_PACKET * 8])
+                        if log_packets:
+                            self._log_packet(event_id, PKT_EVENT_LOST, cur_latency,
+                                             event_queue_delay, sender)
                     else:
                         sender.on_packet_acked(cur_latency)
-                        debug_print('Ack packet at {}'.format(self.cur_time))
+                        if DEBUG:
+                            debug_print('Ack packet at {}'.format(event_time))
                         # log packet acked
-                        if not self.env.train_flag:
-                            self.pkt_log.append(
-                                [self.cur_time, event_id, 'acked',
-                                 BYTES_PER_PACKET, cur_latency,
-                                 event_queue_delay, self.links[0].pkt_in_queue,
-                                 sender.rate * BYTES_PER_PACKET * 8,
-                                 self.links[0].get_bandwidth(self.cur_time) * BYTES_PER_PACKET * 8])
+                        if log_packets:
+                            self._log_packet(event_id, PKT_EVENT_ACKED, cur_latency,
+                                             event_queue_delay, sender)
                 else:
-                    if not self.env.train_flag:
-                        self.pkt_log.append(
-                            [self.cur_time, event_id, 'arrived',
-                             BYTES_PER_PACKET, cur_latency, event_queue_delay,
-                             self.links[0].pkt_in_queue,
-                             sender.rate * BYTES_PER_PACKET * 8,
-                             self.links[0].get_bandwidth(self.cur_time) * BYTES_PER_PACKET * 8])
+                    if log_packets:
+                        self._log_packet(event_id, PKT_EVENT_ARRIVED, cur_latency,
+                                         event_queue_delay, sender)
                     new_next_hop = next_hop + 1
-                    new_event_queue_delay += sender.path[next_hop].get_cur_queue_delay(
-                        self.cur_time)
-                    link_latency = sender.path[next_hop].get_cur_latency(
-                        self.cur_time)
+                    link_latency, link_queue_delay, _ = \
+                        path[next_hop].get_cur_latency_queue_delay_and_bw(
+                            event_time)
+                    new_event_queue_delay += link_queue_delay
                     # link_latency *= self.env.current_trace.get_delay_noise_replay(self.cur_time)
                     # if USE_LATENCY_NOISE:
                     # link_latency *= random.uniform(1.0, MAX_LATENCY_NOISE)
                     new_latency += link_latency
                     new_event_time += link_latency
                     push_new_event = True
-            elif event_type == EVENT_TYPE_SEND:
+            else:  # EVENT_TYPE_SEND, the only other event type
                 if next_hop == 0:
                     if sender.can_send_packet():
                         sender.on_packet_sent()
                         # print('Send packet at {}'.format(self.cur_time))
-                        if not self.env.train_flag:
-                            self.pkt_log.append(
-                                [self.cur_time, event_id, 'sent',
-                                 BYTES_PER_PACKET, cur_latency,
-                                 event_queue_delay, self.links[0].pkt_in_queue,
-                                 sender.rate * BYTES_PER_PACKET * 8,
-                                 self.links[0].get_bandwidth(self.cur_time) * BYTES_PER_PACKET * 8])
+                        if log_packets:
+                            self._log_packet(event_id, PKT_EVENT_SENT, cur_latency,
+                                             event_queue_delay, sender)
                         push_new_event = True
-                    heapq.heappush(self.q, (self.cur_time + (1.0 / sender.rate),
-                                            sender, EVENT_TYPE_SEND, 0, 0.0,
-                                            False, self.event_count, sender.rto,
-                                            0))
-                    self.event_count += 1
+                    heappush(q, (event_time + sender.inv_rate, event_count,
+                                 EVENT_TYPE_SEND, 0, 0.0, False, sender.rto,
+                                 0))
+                    event_count += 1
 
                 else:
                     push_new_event = True
 
-                if next_hop == sender.dest:
+                if next_hop == dest:
                     new_event_type = EVENT_TYPE_ACK
                 new_next_hop = next_hop + 1
 
-                new_event_queue_delay += sender.path[next_hop].get_cur_queue_delay(
-                    self.cur_time)
-                link_latency = sender.path[next_hop].get_cur_latency(
-                    self.cur_time)
+                link = path[next_hop]
+                link_latency, link_queue_delay, link_bw = \
+                    link.get_cur_latency_queue_delay_and_bw(event_time)
+                new_event_queue_delay += link_queue_delay
                 # if USE_LATENCY_NOISE:
                 # link_latency *= random.uniform(1.0, MAX_LATENCY_NOISE)
                 # link_latency += self.env.current_trace.get_delay_noise(
@@ -237,64 +322,78 @@ class Network():
                 # link_latency *= self.env.current_trace.get_delay_noise_replay(self.cur_time)
                 new_latency += link_latency
                 new_event_time += link_latency
-                new_dropped = not sender.path[next_hop].packet_enters_link(
-                    self.cur_time)
-                extra_delays.append(
-                    1 / self.links[0].get_bandwidth(self.cur_time))
+                new_dropped = not link.packet_enters_link(event_time, link_bw)
+                if n_extra_delays == extra_delays.shape[0]:
+                    extra_delays = np.resize(extra_delays, 2 * n_extra_delays)
+                    self._extra_delays = extra_delays
+                extra_delays[n_extra_delays] = 1 / (
+                    link_bw if link is link0 else link0.get_bandwidth(event_time))
+                n_extra_delays += 1
                 if not new_dropped:
-                    sender.queue_delay_samples.append(new_event_queue_delay)
+                    sender.add_queue_delay_sample(new_event_queue_delay)
 
             if push_new_event:
-                heapq.heappush(self.q, (new_event_time, sender, new_event_type,
-                                        new_next_hop, new_latency, new_dropped,
-                                        event_id, rto, new_event_queue_delay))
-        for sender in self.senders:
-            sender.record_run()
+                heappush(q, (new_event_time, event_id, new_event_type,
+                             new_next_hop, new_latency, new_dropped,
+                             rto, new_event_queue_delay))
+        self.event_count = event_count
+        sender.record_run()
 
-        sender_mi = self.senders[0].history.back() #get_run_data()
+        sender_mi = sender.history.back() #get_run_data()
         throughput = sender_mi.get("recv rate")  # bits/sec
         latency = sender_mi.get("avg latency")  # second
         loss = sender_mi.get("loss ratio")
+        rtt_samples = sender_mi.rtt_samples
         debug_print("thpt %f, delay %f, loss %f, bytes sent %f, bytes acked %f" % (
             throughput/1e6, latency, loss, sender_mi.bytes_sent, sender_mi.bytes_acked))
         reward = pcc_aurora_reward(
             throughput / 8 / BYTES_PER_PACKET, latency, loss,
-            np.mean(self.env.current_trace.bandwidths) * 1e6 / 8 / BYTES_PER_PACKET,
-            np.mean(self.env.current_trace.delays) * 2 / 1e3)
+            self.env.current_trace.mean_bandwidth * 1e6 / 8 / BYTES_PER_PACKET,
+            self.env.current_trace.mean_delay * 2 / 1e3)
 
         if latency > 0.0:
             self.env.run_dur = MI_RTT_PROPORTION * \
-                sender_mi.get("avg latency") + np.mean(extra_delays)
+                latency + np.mean(extra_delays[:n_extra_delays])
         # elif self.env.run_dur != 0.01:
             # assert self.env.run_dur >= 0.03
             # self.env.run_dur = max(MI_RTT_PROPORTION * sender_mi.get("avg latency"), 5 * (1 / self.senders[0].rate))
 
-        self.senders[0].avg_latency = sender_mi.get("avg latency")  # second
-        self.senders[0].recv_rate = round(sender_mi.get("recv rate"), 3)  # bits/sec
-        self.senders[0].send_rate = round(sender_mi.get("send rate"), 3)  # bits/sec
-        self.senders[0].lat_diff = sender_mi.rtt_samples[-1] - sender_mi.rtt_samples[0]
-        self.senders[0].latest_rtt = sender_mi.rtt_samples[-1]
-        self.recv_rate_cache.append(self.senders[0].recv_rate)
-        if len(self.recv_rate_cache) > 6:
-            self.recv_rate_cache = self.recv_rate_cache[1:]
-        self.senders[0].max_tput = max(self.recv_rate_cache)
-
-        if self.senders[0].lat_diff == 0 and self.senders[0].start_stage:  # no latency change
+        sender.avg_latency = latency  # second
+        sender.recv_rate = throughput  # bits/sec
+        sender.send_rate = sender_mi.get("send rate")  # bits/sec
+        lat_diff = rtt_samples[-1] - rtt_samples[0]
+        sender.lat_diff = lat_diff
+        sender.latest_rtt = rtt_samples[-1]
+        self.recv_rate_cache.append(throughput)
+        sender.max_tput = max(self.recv_rate_cache)
+
+        if lat_diff == 0 and sender.start_stage:  # no latency change
             pass
             # self.senders[0].max_tput = max(self.senders[0].recv_rate, self.senders[0].max_tput)
-        elif self.senders[0].lat_diff == 0 and not self.senders[0].start_stage:  # no latency change
+        elif lat_diff == 0 and not sender.start_stage:  # no latency change
             pass
             # self.senders[0].max_tput = max(self.senders[0].recv_rate, self.senders[0].max_tput)
-        elif self.senders[0].lat_diff > 0:  # latency increase
-            self.senders[0].start_stage = False
+        elif lat_diff > 0:  # latency increase
+            sender.start_stage = False
             # self.senders[0].max_tput = self.senders[0].recv_rate # , self.max_tput)
         else:  # latency decrease
-            self.senders[0].start_stage = False
+            sender.start_stage = False
             # self.senders[0].max_tput = max(self.senders[0].recv_rate, self.senders[0].max_tput)
         return reward * REWARD_SCALE
 
 
 class Sender():
+    # the event loop reads and writes sender state on every event, so the
+    # attributes live in slots instead of a per-instance dict
+    __slots__ = ('id', 'delta_scale', 'starting_rate', 'rate', 'sent', 'acked',
+                 'lost', 'bytes_in_flight', 'min_latency', '_rtt_buf',
+                 '_rtt_ts_buf', 'n_rtt_samples', '_queue_delay_buf',
+                 'n_queue_delay_samples', 'prev_rtt_samples', 'sample_time', 'net', 'path', 'dest', 'history_len',
+                 'features', 'history', 'cwnd', 'use_cwnd', 'rto', 'ssthresh',
+                 'pkt_loss_wait_time', 'estRTT', 'RTTVar', 'got_data',
+                 'min_rtt', 'max_tput', 'start_stage', 'lat_diff', 'recv_rate',
+                 'send_rate', 'avg_latency', 'latest_rtt', 'obs_start_time',
+                 'inv_rate')
 
     def __init__(self, rate, path, dest, features, cwnd=25, history_len=10,
                  delta_scale=1):
@@ -302,15 +401,20 @@ class Sender():
         self.delta_scale = delta_scale
         self.starting_rate = rate
         self.rate = rate
+        self.inv_rate = 1.0 / rate  # time between two packets sent
         self.sent = 0
         self.acked = 0
         self.lost = 0
         self.bytes_in_flight = 0
         self.min_latency = None
-        self.rtt_samples = []
-        self.rtt_samples_ts = []
-        self.queue_delay_samples = []
-        self.prev_rtt_samples = self.rtt_samples
+        # samples of the current MI are stored in buffers which are reused
+        # across MIs and grown on demand
+        self._rtt_buf = np.empty(SAMPLE_BUFFER_CAPACITY)
+        self._rtt_ts_buf = np.empty(SAMPLE_BUFFER_CAPACITY)
+        self.n_rtt_samples = 0
+        self._queue_delay_buf = np.empty(SAMPLE_BUFFER_CAPACITY)
+        self.n_queue_delay_samples = 0
+        self.prev_rtt_samples = []
         self.sample_time = []
         self.net = None
         self.path = path
@@ -375,20 +479,53 @@ class Sender():
         self.bytes_in_flight += BYTES_PER_PACKET
 
     def on_packet_acked(self, rtt):
-        self.min_rtt = min(self.min_rtt, rtt)
-        self.estRTT = (7.0 * self.estRTT + rtt) / 8.0  # RTT of emulation way
-        self.RTTVar = (self.RTTVar * 7.0 + abs(rtt - self.estRTT) * 1.0) / 8.0
+        if rtt < self.min_rtt:
+            self.min_rtt = rtt
+        # EWMAs with weight 1/8 on the new sample, RTT of emulation way
+        estRTT = self.estRTT
+        estRTT -= 0.125 * (estRTT - rtt)
+        self.estRTT = estRTT
+        rtt_dev = rtt - estRTT
+        if rtt_dev < 0.0:
+            rtt_dev = -rtt_dev
+        RTTVar = self.RTTVar
+        self.RTTVar = RTTVar - 0.125 * (RTTVar - rtt_dev)
 
         self.acked += 1
-        self.rtt_samples.append(rtt)
-        self.rtt_samples_ts.append(self.net.get_cur_time())
+        i = self.n_rtt_samples
+        if i == self._rtt_buf.shape[0]:
+            self._rtt_buf = np.resize(self._rtt_buf, 2 * i)
+            self._rtt_ts_buf = np.resize(self._rtt_ts_buf, 2 * i)
+        self._rtt_buf[i] = rtt
+        self._rtt_ts_buf[i] = self.net.cur_time
+        self.n_rtt_samples = i + 1
         # self.rtt_samples.append(self.estRTT)
-        if (self.min_latency is None) or (rtt < self.min_latency):
+        min_latency = self.min_latency
+        if (min_latency is None) or (rtt < min_latency):
             self.min_latency = rtt
         self.bytes_in_flight -= BYTES_PER_PACKET
-        if not self.got_data:
-            self.got_data = len(self.rtt_samples) >= 1
-        # self.got_data = True
+        # rtt_samples is not empty after the sample above
+        self.got_data = True
+
+    @property
+    def rtt_samples(self):
+        """RTT samples of the current MI, as a view of the sample buffer."""
+        return self._rtt_buf[:self.n_rtt_samples]
+
+    @property
+    def rtt_samples_ts(self):
+        return self._rtt_ts_buf[:self.n_rtt_samples]
+
+    @property
+    def queue_delay_samples(self):
+        return self._queue_delay_buf[:self.n_queue_delay_samples]
+
+    def add_queue_delay_sample(self, queue_delay):
+        i = self.n_queue_delay_samples
+        if i == self._queue_delay_buf.shape[0]:
+            self._queue_delay_buf = np.resize(self._queue_delay_buf, 2 * i)
+        self._queue_delay_buf[i] = queue_delay
+        self.n_queue_delay_samples = i + 1
 
     def on_packet_lost(self, rtt):
         self.lost += 1
@@ -401,6 +538,7 @@ class Sender():
             self.rate = MAX_RATE
         if self.rate < MIN_RATE:
             self.rate = MIN_RATE
+        self.inv_rate = 1.0 / self.rate
 
     def set_cwnd(self, new_cwnd):
         self.cwnd = int(new_cwnd)
@@ -429,10 +567,12 @@ class Sender():
         #print("Sent %d packets in %f seconds" % (self.sent, obs_dur))
         #print("self.rate = %f" % self.rate)
         # print(self.acked, self.sent)
-        if not self.rtt_samples and self.prev_rtt_samples:
+        n_rtt_samples = self.n_rtt_samples
+        if not n_rtt_samples and len(self.prev_rtt_samples):
             rtt_samples = [np.mean(self.prev_rtt_samples)]
         else:
-            rtt_samples = self.rtt_samples
+            # the MI keeps its own copy since the buffer is reused
+            rtt_samples = self._rtt_buf[:n_rtt_samples].copy()
         # if not self.rtt_samples:
         #     print(self.obs_start_time, obs_end_time, self.rate)
         # rtt_samples is empty when there is no packet acked in MI
@@ -440,13 +580,13 @@ class Sender():
 
         # recv_start = self.rtt_samples_ts[0] if len(
         #     self.rtt_samples) >= 2 else self.obs_start_time
-        recv_start = self.history.back().recv_end if len(
-            self.rtt_samples) >= 1 else self.obs_start_time
-        recv_end = self.rtt_samples_ts[-1] if len(
-            self.rtt_samples) >= 1 else obs_end_time
+        recv_start = self.history.back().recv_end if \
+            n_rtt_samples >= 1 else self.obs_start_time
+        recv_end = float(self._rtt_ts_buf[n_rtt_samples - 1]) if \
+            n_rtt_samples >= 1 else obs_end_time
         bytes_acked = self.acked * BYTES_PER_PACKET
         if recv_start == 0:
-            recv_start = self.rtt_samples_ts[0]
+            recv_start = float(self._rtt_ts_buf[0])
             bytes_acked = (self.acked - 1) * BYTES_PER_PACKET
 
         # bytes_acked = max(0, (self.acked-1)) * BYTES_PER_PACKET if len(
@@ -465,7 +605,7 @@ class Sender():
             recv_start=recv_start,
             recv_end=recv_end,
             rtt_samples=rtt_samples,
-            queue_delay_samples=self.queue_delay_samples,
+            queue_delay_samples=self.queue_delay_samples.copy(),
             packet_size=BYTES_PER_PACKET
         )
 
@@ -473,11 +613,10 @@ class Sender():
         self.sent = 0
         self.acked = 0
         self.lost = 0
-        if self.rtt_samples:
-            self.prev_rtt_samples = self.rtt_samples
-        self.rtt_samples = []
-        self.rtt_samples_ts = []
-        self.queue_delay_samples = []
+        if self.n_rtt_samples:
+            self.prev_rtt_samples = self.rtt_samples.copy()
+        self.n_rtt_samples = 0
+        self.n_queue_delay_samples = 0
         self.obs_start_time = self.net.get_cur_time()
 
     def print_debug(self):
@@ -492,6 +631,7 @@ class Sender():
     def reset(self):
         #print("Resetting sender!")
         self.rate = self.starting_rate
+        self.inv_rate = 1.0 / self.rate
         self.bytes_in_flight = 0
         self.min_latency = None
         self.reset_obs()
@@ -515,6 +655,16 @@ class Sender():
         pass
 
 
+@functools.lru_cache(maxsize=8)
+def _make_obs_space(features, history_len):
+    """Observation space shared by environments with the same features."""
+    single_obs_min_vec = sender_obs.get_min_obs_vector(features)
+    single_obs_max_vec = sender_obs.get_max_obs_vector(features)
+    return spaces.Box(np.tile(single_obs_min_vec, history_len),
+                      np.tile(single_obs_max_vec, history_len),
+                      dtype=np.float32)
+
+
 class SimulatedNetworkEnv(gym.Env):
 
     def __init__(self, traces, history_len=10,
@@ -532,7 +682,7 @@ class SimulatedNetworkEnv(gym.Env):
         self.config_file = config_file
         self.delta_scale = delta_scale
         self.traces = traces
-        self.current_trace = np.random.choice(self.traces)
+        self.current_trace = self.traces[np.random.randint(len(self.traces))]
         self.train_flag = train_flag
         self.congestion_control_type = congestion_control_type
         if self.congestion_control_type == 'aurora':
@@ -565,12 +715,8 @@ class SimulatedNetworkEnv(gym.Env):
 
         self.observation_space = None
         # use_only_scale_free = True
-        single_obs_min_vec = sender_obs.get_min_obs_vector(self.features)
-        single_obs_max_vec = sender_obs.get_max_obs_vector(self.features)
-        self.observation_space = spaces.Box(np.tile(single_obs_min_vec, self.history_len),
-                                            np.tile(single_obs_max_vec,
-                                                    self.history_len),
-                                            dtype=np.float32)
+        self.observation_space = _make_obs_space(tuple(self.features),
+                                                 self.history_len)
         # single_obs_min_vec = np.array([0, 0, -1e12, 0, 0, 0, 0])
         # single_obs_max_vec =  np.array([1e12, 1e12, 1e12, 1, 1e12, 1e12, 1e12])
         # self.observation_space = spaces.Box(single_obs_min_vec,
@@ -664,7 +810,7 @@ class SimulatedNetworkEnv(gym.Env):
                 self.congestion_control_type))
         # self.run_dur = 3 * lat
         # self.run_dur = 1 * lat
-        if not self.senders[0].rtt_samples:
+        if not self.senders[0].n_rtt_samples:
             # self.run_dur = 0.473
             # self.run_dur = 5 / self.senders[0].rate
             self.run_dur = 0.01
@@ -674,7 +820,7 @@ class SimulatedNetworkEnv(gym.Env):
     def reset(self):
         self.steps_taken = 0
         self.net.reset()
-        self.current_trace = np.random.choice(self.traces)
+        self.current_trace = self.traces[np.random.randint(len(self.traces))]
         self.current_trace.reset()
         self.create_new_links_and_senders()
         self.net = Network(self.senders, self.links, self)
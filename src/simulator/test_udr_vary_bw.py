@@ -52,10 +52,7 @@ def parse_args():
     return parser.parse_args()
 
 
-def multiple_runs(aurora_models, trace_files, aurora_save_dirs, plot_only):
-    test_traces = [Trace.load_from_file(trace_file)
-                   for trace_file in trace_files]
-
+def multiple_runs(aurora_models, test_traces, aurora_save_dirs, plot_only):
     rollout_time = 0
     step_cnt = 0
     for aurora in aurora_models:
@@ -134,6 +131,8 @@ def main():
     cubic_rewards = []
     cubic_reward_errs = []
     cubic_time = 0
+    # traces of each val are parsed once and reused by cubic and every model
+    traces_by_val = {}
     for _, val in config[metric]:
         trace_files = sorted(glob.glob(os.path.join(
             args.trace_dir, str(val), "trace*.json")))
@@ -148,6 +147,7 @@ def main():
         t_start = time.time()
         traces = [Trace.load_from_file(trace_file)
                   for trace_file in trace_files]
+        traces_by_val[val] = traces
         mi_rewards, pkt_logs = test_on_traces(
             traces, cubic_save_dirs, args.seed)
         cubic_time += time.time() - t_start
@@ -207,7 +207,8 @@ def main():
                 os.makedirs(aurora_save_dir, exist_ok=True)
             # run aurora
             aurora_reward, aurora_reward_err, aurora_rollout_time, aurora_step_cnt = multiple_runs(
-                last_n_auroras, trace_files, aurora_save_dirs, args.plot_only)
+                last_n_auroras, traces_by_val[val], aurora_save_dirs,
+                args.plot_only)
 
             aurora_rollout_time_tot += aurora_rollout_time
             aurora_step_cnt_tot += aurora_step_cnt
@@ -1,10 +1,12 @@
 import argparse
 import csv
-import glob
+import functools
 import itertools
+import multiprocessing as mp
 import os
 import subprocess
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib
 import matplotlib.pyplot as plt
@@ -15,10 +17,22 @@ from plot_scripts.plot_packet_log import PacketLog
 from common.utils import natural_sort, read_json_file, set_seed
 from simulator.aurora import Aurora
 from simulator.trace import generate_trace, generate_traces, Trace
-from simulator.evaluate_cubic import test_on_traces
+from simulator.evaluate_cubic import test_on_trace
 
 matplotlib.use('Agg')
 
+METRIC_XLABELS = {
+    'bandwidth': "Bandwidth (log(Mbps))",
+    'delay': 'Delay (ms)',
+    'loss': 'loss',
+    'queue': 'queue (packets)',
+    'duration': 's',
+    'T_s': 'Bandwidth Change Period (s)',
+    'd_delay': '',
+    'd_bw': 'Bandwidth ~ [1, 1+x] Mbps',
+    'delay_noise': 'ms',
+}
+
 
 def parse_args():
     """Parse arguments from the command line."""
@@ -52,20 +66,42 @@ def parse_args():
     return parser.parse_args()
 
 
-def multiple_runs(aurora_models, trace_files, aurora_save_dirs, plot_only):
-    test_traces = [Trace.load_from_file(trace_file)
-                   for trace_file in trace_files]
+def segment_mean_and_err(values, offsets):
+    """Mean and standard error of each values[offsets[i]:offsets[i + 1]].
+
+    Both are nan for an empty segment.
+    """
+    counts = np.diff(offsets)
+    nonempty = counts > 0
+    # reduceat only gets the starts of non-empty segments, an empty segment
+    # would be summed as a single value or start past the end of values
+    starts = np.asarray(offsets[:-1])[nonempty]
+    nonempty_counts = counts[nonempty]
+    means = np.full(len(counts), np.nan)
+    errs = np.full(len(counts), np.nan)
+    if len(starts) > 0:
+        means[nonempty] = np.add.reduceat(values, starts) / nonempty_counts
+        sq_devs = (values - np.repeat(means, counts)) ** 2
+        errs[nonempty] = np.sqrt(np.add.reduceat(sq_devs, starts) /
+                                 nonempty_counts) / np.sqrt(nonempty_counts)
+    return means, errs
+
 
-    rollout_time = 0
+def multiple_runs(aurora, model_paths, test_traces, aurora_save_dirs,
+                  plot_only, n_proc=None):
     step_cnt = 0
-    for aurora in aurora_models:
+    rewards_per_model = []
+    t_start = time.time()
+    for model_path in model_paths:
+        # checkpoints share one graph, only the weights are swapped
+        if aurora.pretrained_model_path != model_path:
+            aurora.reload_checkpoint(model_path)
         aurora_log_dirs = [os.path.join(aurora_save_dir, os.path.splitext(os.path.basename(
             aurora.pretrained_model_path))[0])for aurora_save_dir in aurora_save_dirs]
-        for aurora_log_dir in aurora_log_dirs:
-            os.makedirs(aurora_log_dir, exist_ok=True)
-        t_start = time.time()
+        # the log dirs are created, once per process, by Aurora's test episodes
         # if not plot_only:
-        results, pkt_logs = aurora.test_on_traces(test_traces, aurora_log_dirs)
+        results, pkt_logs = aurora.test_on_traces(
+            test_traces, aurora_log_dirs, n_proc=n_proc)
         step_cnt += len(results[0])
         # for trace_file, pkt_log, aurora_log_dir in zip(trace_files, pkt_logs, aurora_log_dirs):
         #     with open(os.path.join(aurora_log_dir, "aurora_packet_log.csv"), 'w', 1) as f:
@@ -83,26 +119,92 @@ def multiple_runs(aurora_models, trace_files, aurora_save_dirs, plot_only):
         #     print(cmd)
         #     subprocess.check_output(cmd, shell=True).strip()
         #     break
-        rollout_time += time.time() - t_start
 
-        rewards = np.array([np.mean([row[1] for row in result]) for result in results])
+        # episodes differ in length, so the reward columns are read into one
+        # flat array and reduced per episode
+        lengths = [len(result) for result in results]
+        rewards_per_model.append(segment_mean_and_err(
+            np.fromiter((row[1] for result in results for row in result),
+                        dtype=float, count=sum(lengths)),
+            np.cumsum([0] + lengths))[0])
         # rewards = np.array([PacketLog.from_log(pkt_log).get_reward()
         #                     for pkt_log in pkt_logs])
-        mean_reward = np.mean(rewards)
-        reward_err = float(np.std(rewards)) / np.sqrt(len(rewards))
-        return mean_reward, reward_err, rollout_time, step_cnt
+    rollout_time = time.time() - t_start
+    # average each trace's reward over all the last n checkpoints
+    rewards = np.mean(rewards_per_model, axis=0)
+    return rewards, rollout_time, step_cnt
+
+
+_WORKER_AURORAS = {}
+
+
+@functools.lru_cache(maxsize=None)
+def _load_trace(trace_path):
+    return Trace.load_from_file(trace_path)
+
+
+def load_trace(trace_file):
+    """Load a trace file, parsing each file only once per process."""
+    return _load_trace(os.path.realpath(trace_file))
+
+
+def init_worker(cpu_queue, seed):
+    """Pin a pool worker to its own cpu and seed it like the parent."""
+    cpu = cpu_queue.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {cpu})
+    set_seed(seed)
+
+
+def run_cubic_on_traces(traces, save_dirs, seed):
+    t_start = time.time()
+    # pool workers are daemonic and cannot start a pool of their own, so the
+    # traces of a chunk are run back to back here
+    mi_rewards = [test_on_trace(trace, save_dir, seed)[0]
+                  for trace, save_dir in zip(traces, save_dirs)]
+    return mi_rewards, time.time() - t_start
+
+
+def run_aurora_on_traces(traces, save_dirs, model_paths, delta_scale,
+                         seed):
+    # tensorflow sessions are not fork-safe, so the model is built inside the
+    # worker and kept for the next chunk it is handed
+    key = (seed, delta_scale)
+    if key not in _WORKER_AURORAS:
+        _WORKER_AURORAS[key] = Aurora(
+            seed=seed, log_dir="", timesteps_per_actorbatch=10,
+            pretrained_model_path=model_paths[0], delta_scale=delta_scale)
+    return multiple_runs(_WORKER_AURORAS[key], model_paths, traces, save_dirs,
+                         False, n_proc=1)
+
+
+def submit_in_chunks(executor, n_chunks, func, traces, save_dirs, *args):
+    """Submit func over contiguous chunks of traces and save_dirs.
+
+    Returns the futures in chunk order.
+    """
+    bounds = np.linspace(0, len(traces), n_chunks + 1).astype(int)
+    return [executor.submit(func, traces[start:end], save_dirs[start:end],
+                            *args)
+            for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
 
 
 def get_last_n_models(model_path, n_models):
     parent_dir = os.path.dirname(model_path)
-    ckpt_index_files = natural_sort(
-        glob.glob(os.path.join(parent_dir, "model_step_*.ckpt.index")))
-    target_model_ctime = os.path.getctime(model_path + ".index")
+    # one scandir pass stats every checkpoint index file, the target included
+    with os.scandir(parent_dir or '.') as entries:
+        ckpt_ctimes = {entry.name: entry.stat().st_ctime for entry in entries
+                       if entry.name.startswith('model_step_') and
+                       entry.name.endswith('.ckpt.index')}
+    target_model_ctime = ckpt_ctimes.get(os.path.basename(model_path) + ".index")
+    if target_model_ctime is None:
+        target_model_ctime = os.path.getctime(model_path + ".index")
     ckpt_paths = []
-    for ckpt_index_file in ckpt_index_files[::-1]:
-        if os.path.getctime(ckpt_index_file) > target_model_ctime:
+    for ckpt_index_file in natural_sort(ckpt_ctimes)[::-1]:
+        if ckpt_ctimes[ckpt_index_file] > target_model_ctime:
             continue
-        ckpt_paths.append(os.path.splitext(ckpt_index_file)[0])
+        ckpt_paths.append(os.path.join(
+            parent_dir, os.path.splitext(ckpt_index_file)[0]))
         if len(ckpt_paths) >= n_models:
             return ckpt_paths
     return ckpt_paths
@@ -119,7 +221,7 @@ def main():
     train_config_dir = args.train_config_dir
     # print(metric, model_paths, save_root, config_file)
 
-    plt.figure(figsize=(12, 8))
+    fig, ax = plt.subplots(figsize=(12, 8))
     # config = read_json_file(config_file)
     # # print(config)
     # bw_list = config['bandwidth']
@@ -131,109 +233,103 @@ def main():
     # duration_list = config["duration"]
     # ack_delay_prob_list = config["ack_delay_prob"] if "ack_delay_prob" in config else [
     #     [0, 0]]
-    metric_vals = natural_sort(os.listdir(args.trace_dir))
-    if metric in ['loss', 'bandwidth', 'd_delay', 'd_bandwidth', 'delay_noise']:
-        metric_vals = list(sorted([float(val) for val in metric_vals]))
+    # metric values are parsed once, metric_vals keeps them as path components
+    if metric in {'loss', 'bandwidth', 'd_delay', 'd_bandwidth', 'delay_noise'}:
+        metric_floats = np.sort(np.array(os.listdir(args.trace_dir), dtype=float))
+        metric_vals = [str(val) for val in metric_floats]
+    else:
+        metric_vals = natural_sort(os.listdir(args.trace_dir))
+        metric_floats = np.array(metric_vals, dtype=float)
+    metric2plot = np.log10(metric_floats) if metric == 'bandwidth' else metric_floats
     print(metric_vals)
 
-    # run cubic
-    cubic_rewards = []
-    cubic_reward_errs = []
-    cubic_time = 0
+    # traces of all metric values are laid out back to back and tested in a
+    # few large chunks, one per worker, each pinned to its own cpu
+    # val_offsets slices the per-trace rewards back by metric value
+    trace_files_by_val = {}
     for val in metric_vals:
-        trace_files = sorted(glob.glob(os.path.join(
-            args.trace_dir, str(val), "trace*.json")))
-        trace_files = [trace_files[0]]
-        save_dirs = [os.path.join(save_root, f"rand_{metric}", str(val),
-                                  os.path.splitext(os.path.basename(trace_file))[0])
-                     for trace_file in trace_files]
-        cubic_save_dirs = [os.path.join(save_dir, "cubic")
-                           for save_dir in save_dirs]
-        for cubic_save_dir in cubic_save_dirs:
-            os.makedirs(cubic_save_dir, exist_ok=True)
-        # if not args.plot_only:
-        t_start = time.time()
-        traces = [Trace.load_from_file(trace_file)
-                  for trace_file in trace_files]
-        mi_rewards, pkt_logs = test_on_traces(
-            traces, cubic_save_dirs, args.seed)
-        cubic_time += time.time() - t_start
-        # for trace_file, cubic_save_dir in zip(trace_files, cubic_save_dirs):
-        #     cmd = "python ../plot_scripts/plot_packet_log.py --log-file {} " \
-        #         "--save-dir {} --trace-file {}".format(
-        #             os.path.join(cubic_save_dir, "cubic_packet_log.csv"),
-        #             cubic_save_dir, trace_file)
-        #     subprocess.check_output(cmd, shell=True).strip()
-        #     cmd = "python ../plot_scripts/plot_time_series.py --log-file {} " \
-        #         "--save-dir {} --trace-file {}".format(
-        #             os.path.join(cubic_save_dir, "cubic_simulation_log.csv"),
-        #             cubic_save_dir, trace_file)
-        #     print(cmd)
-        #     subprocess.check_output(cmd, shell=True).strip()
-        #     break
-        # df = pd.read_csv(os.path.join(
-        #     cubic_save_dir, "cubic_test_log.csv"))
-        # cubic_rewards.append(df['reward'].mean())
-        # multi_trace_cubic_rewards = [PacketLog.from_log_file(
-        #     os.path.join(cubic_save_dir, "cubic_packet_log.csv")).get_reward()
-        #     for cubic_save_dir in cubic_save_dirs]
-
-        multi_trace_cubic_rewards = np.array([np.mean(mi_reward) for mi_reward in mi_rewards])
-        # multi_trace_cubic_rewards = [PacketLog.from_log(pkt_log).get_reward()
-        #                              for pkt_log in pkt_logs]
-        cubic_rewards.append(np.mean(np.array(multi_trace_cubic_rewards)))
-        cubic_reward_errs.append(float(np.std(np.array(multi_trace_cubic_rewards))) /
-                                 np.sqrt(len(multi_trace_cubic_rewards)))
+        val_dir = os.path.join(args.trace_dir, str(val))
+        trace_files_by_val[val] = [
+            os.path.join(val_dir, fname) for fname in natural_sort(os.listdir(val_dir))
+            if fname.startswith('trace') and fname.endswith('.json')]
+    val_trace_files = [trace_files_by_val[val] for val in metric_vals]
+    val_offsets = np.cumsum([0] + [len(trace_files)
+                                   for trace_files in val_trace_files])
+    flat_trace_files = [trace_file for trace_files in val_trace_files
+                        for trace_file in trace_files]
+    flat_save_dirs = [os.path.join(save_root, f"rand_{metric}", str(val),
+                                   os.path.splitext(os.path.basename(trace_file))[0])
+                      for val, trace_files in zip(metric_vals, val_trace_files)
+                      for trace_file in trace_files]
+    # traces are parsed once here and shared by cubic and every model
+    flat_traces = [load_trace(trace_file) for trace_file in flat_trace_files]
+
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(
+        os, 'sched_getaffinity') else list(range(mp.cpu_count()))
+    n_proc = max(1, len(cpus) // 2)
+    # spawn instead of fork since tensorflow state is not fork-safe
+    mp_ctx = mp.get_context('spawn')
+    cpu_queue = mp_ctx.Queue()
+    for cpu in cpus[:n_proc]:
+        cpu_queue.put(cpu)
+    executor = ProcessPoolExecutor(max_workers=n_proc, mp_context=mp_ctx,
+                                   initializer=init_worker,
+                                   initargs=(cpu_queue, args.seed))
+
+    # run cubic on the first trace of every metric value
+    cubic_time = 0
+    cubic_traces = [flat_traces[val_offsets[i]] for i in range(len(metric_vals))]
+    cubic_save_dirs = [os.path.join(flat_save_dirs[val_offsets[i]], "cubic")
+                       for i in range(len(metric_vals))]
+    for cubic_save_dir in set(cubic_save_dirs):
+        os.makedirs(cubic_save_dir, exist_ok=True)
+    # if not args.plot_only:
+    mi_rewards = []
+    # one job per cubic trace, so the executor balances them across workers
+    for future in submit_in_chunks(executor, len(cubic_traces), run_cubic_on_traces,
+                                   cubic_traces, cubic_save_dirs, args.seed):
+        chunk_mi_rewards, chunk_time = future.result()
+        mi_rewards += chunk_mi_rewards
+        cubic_time += chunk_time
+    lengths = [len(mi_reward) for mi_reward in mi_rewards]
+    multi_trace_cubic_rewards = segment_mean_and_err(
+        np.fromiter(itertools.chain.from_iterable(mi_rewards), dtype=float,
+                    count=sum(lengths)),
+        np.cumsum([0] + lengths))[0]
+    # multi_trace_cubic_rewards = [PacketLog.from_log(pkt_log).get_reward()
+    #                              for pkt_log in pkt_logs]
+    # one cubic trace per metric value
+    cubic_rewards, cubic_reward_errs = segment_mean_and_err(
+        multi_trace_cubic_rewards, np.arange(len(metric_vals) + 1))
 
     aurora_rollout_time_tot = 0
     aurora_step_cnt_tot = 0
-    model_load_time = 0
-    model_load_cnt = 0
     for model_idx, (model_path, ls, marker, color) in enumerate(
             zip(model_paths, ["-", "--", "-.", "-", "-", "--", "-.", ":"],
                 ["x", "s", "v", '*', '+', '^', '>', '1'],
                 ["C3", "C3", "C3", "C1", "C1", "C1", "C1", "C1"])):
         model_name = os.path.basename(os.path.dirname(os.path.dirname(model_path))) + os.path.basename(os.path.dirname(model_path))
-        aurora_rewards = []
-        aurora_reward_errs = []
         # detect latest n models here
         last_n_model_paths = get_last_n_models(model_path, args.n_models)
-        # construct n Aurora objects and load aurora models here
-        last_n_auroras = []
-        for tmp_model_path in last_n_model_paths:
-            model_load_start = time.time()
-            aurora = Aurora(seed=args.seed, log_dir="", timesteps_per_actorbatch=10,
-                            pretrained_model_path=tmp_model_path,
-                            delta_scale=args.delta_scale)
-            last_n_auroras.append(aurora)
-            model_load_time += (time.time() - model_load_start)
-            model_load_cnt += 1
-
-        for val in metric_vals:
-            trace_files = sorted(glob.glob(os.path.join(
-                args.trace_dir, str(val), "trace*.json")))
-            save_dirs = [os.path.join(save_root, f"rand_{metric}", str(val),
-                                      os.path.splitext(os.path.basename(trace_file))[0])
-                         for trace_file in trace_files]
-            aurora_save_dirs = [os.path.join(save_dir, model_name)
-                                for save_dir in save_dirs]
-            for aurora_save_dir in aurora_save_dirs:
-                os.makedirs(aurora_save_dir, exist_ok=True)
-            # run aurora
-            aurora_reward, aurora_reward_err, aurora_rollout_time, aurora_step_cnt = multiple_runs(
-                last_n_auroras, trace_files, aurora_save_dirs, args.plot_only)
 
+        aurora_save_dirs = [os.path.join(save_dir, model_name)
+                            for save_dir in flat_save_dirs]
+        # run aurora
+        rewards = []
+        for future in submit_in_chunks(
+                executor, n_proc, run_aurora_on_traces, flat_traces,
+                aurora_save_dirs, last_n_model_paths, args.delta_scale, args.seed):
+            chunk_rewards, aurora_rollout_time, aurora_step_cnt = future.result()
+            rewards.append(chunk_rewards)
             aurora_rollout_time_tot += aurora_rollout_time
             aurora_step_cnt_tot += aurora_step_cnt
-            aurora_rewards.append(aurora_reward)
-            aurora_reward_errs.append(aurora_reward_err)
+        aurora_rewards, aurora_reward_errs = segment_mean_and_err(
+            np.concatenate(rewards), val_offsets)
         if model_idx == 0:
-            if metric == 'bandwidth':
-                metric2plot = [np.log10(float(val)) for val in metric_vals]
-            else:
-                metric2plot = [float(val) for val in metric_vals]
-            plt.errorbar(metric2plot, cubic_rewards, yerr=cubic_reward_errs,
-                         marker='o', linestyle='-', c="C0", label="TCP Cubic")
+            ax.errorbar(metric2plot, cubic_rewards, yerr=cubic_reward_errs,
+                        marker='o', linestyle='-', c="C0", label="TCP Cubic",
+                        rasterized=True,
+                        errorevery=max(1, len(metric2plot) // 50))
         if "cont" in model_name:
             model_name = model_name[:-5]
         if train_config_dir is not None and os.path.exists(os.path.join(
@@ -256,10 +352,6 @@ def main():
             env = ""
             # raise RuntimeError
         assert ls in {'', '-', '--', '-.', ':', None}
-        if metric == 'bandwidth':
-            metric2plot = [np.log10(float(val)) for val in metric_vals]
-        else:
-            metric2plot = [float(val) for val in metric_vals]
         if "small" in model_name:
             udr_small_rewards = aurora_rewards
             udr_small_rewards_errs = aurora_reward_errs
@@ -272,48 +364,34 @@ def main():
             udr_large_rewards = aurora_rewards
             udr_large_rewards_errs = aurora_reward_errs
             lgd = "DRL+UDR_3"
-        plt.errorbar(metric2plot, aurora_rewards, yerr=aurora_reward_errs, #marker=marker,
-                     linestyle=ls, c=color, label=lgd)
-    plt.legend(bbox_to_anchor=(0.0, 1.02, 1.0, 0.2), loc="lower left",
-               mode="expand", ncol=1, )
-    plt.legend()
-    if metric == "bandwidth":
-        xlabel = "Bandwidth (log(Mbps))"
-    elif metric == 'delay':
-        xlabel = 'Delay (ms)'
-    elif metric == 'loss':
-        xlabel = 'loss'
-    elif metric == 'queue':
-        xlabel = 'queue (packets)'
-    elif metric == 'duration':
-        xlabel = 's'
-    elif metric == 'T_s':
-        xlabel = 'Bandwidth Change Period (s)'
-    elif metric == 'd_delay':
-        xlabel = ''
-    elif metric == 'd_bw':
-        xlabel = 'Bandwidth ~ [1, 1+x] Mbps'
-    elif metric == 'delay_noise':
-        xlabel = 'ms'
-    else:
-        xlabel = ""
-
-    plt.xlabel("{}".format(xlabel))
-    plt.ylabel('Reward')
-    # plt.title("Tot t: {:.2f}s, Aurora tot rollout t: {:.2f}s, Aurora tot step cnt: {}, model load t: {:.2f}s, load cnt: {}, cubic t: {:.2f}s".format(
-        # time.time() - main_start, aurora_rollout_time_tot, aurora_step_cnt_tot, model_load_time, model_load_cnt, cubic_time))
+        ax.errorbar(metric2plot, aurora_rewards, yerr=aurora_reward_errs, #marker=marker,
+                    linestyle=ls, c=color, label=lgd, rasterized=True,
+                    errorevery=max(1, len(metric2plot) // 50))
+    executor.shutdown(wait=True)
+    ax.legend(loc="best")
+    ax.set_xlabel(METRIC_XLABELS.get(metric, ""))
+    ax.set_ylabel('Reward')
+    # plt.title("Tot t: {:.2f}s, Aurora tot rollout t: {:.2f}s, Aurora tot step cnt: {}, cubic t: {:.2f}s".format(
+        # time.time() - main_start, aurora_rollout_time_tot, aurora_step_cnt_tot, cubic_time))
     # plt.ylabel('log(throughput) - log(delay)')
-    plt.tight_layout()
-    plt.savefig(os.path.join(
+    fig.tight_layout()
+    fig.savefig(os.path.join(
         args.save_dir, "rand_{}_sim.png".format(metric)))
 
-    with open(os.path.join(args.save_dir, 'rand_{}_sim.csv'), 'w', 1) as f:
-        writer = csv.writer(f)
-        writer.writerow(['vals', 'cubic_rewards', 'cubic_rewards_errs',
-                         'udr_small_rewards', 'udr_small_rewards_errs', 'udr_mid_rewards', 'udr_mid_rewards_errs',
-                         'udr_large_rewards', 'udr_large_rewards_errs'])
-        writer.writerows(zip(metric2plot, cubic_rewards, cubic_reward_errs, udr_small_rewards, udr_small_rewards_errs, udr_mid_rewards, udr_mid_rewards_errs, udr_large_rewards, udr_large_rewards_errs))
-    plt.close()
+    table = np.column_stack([
+        metric2plot, cubic_rewards, cubic_reward_errs, udr_small_rewards,
+        udr_small_rewards_errs, udr_mid_rewards, udr_mid_rewards_errs,
+        udr_large_rewards, udr_large_rewards_errs]).astype(np.float64)
+    # np.savetxt formats and writes row by row, so the whole file is
+    # built as one string and written at once instead
+    lines = [','.join(['vals', 'cubic_rewards', 'cubic_rewards_errs',
+                       'udr_small_rewards', 'udr_small_rewards_errs',
+                       'udr_mid_rewards', 'udr_mid_rewards_errs',
+                       'udr_large_rewards', 'udr_large_rewards_errs'])]
+    lines += [','.join(map(str, row)) for row in table.tolist()]
+    with open(os.path.join(args.save_dir, f'rand_{metric}_sim.csv'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    plt.close(fig)
     # plt.show()
 
 
@@ -1,7 +1,8 @@
 import argparse
-from bisect import bisect_right
-import copy
+from bisect import bisect_left, bisect_right
 import csv
+from itertools import accumulate
+import multiprocessing as mp
 import os
 from typing import List, Tuple, Union
 
@@ -32,6 +33,9 @@ class Trace():
                  queue_size: int, delay_noise: float = 0, offset=0):
         assert len(timestamps) == len(bandwidths)
         self.timestamps = timestamps
+        # fixed for the life of the trace and read on every simulator step
+        self._n_ts = len(timestamps)
+        self._duration = float(timestamps[-1])
         if len(timestamps) >= 2:
             self.dt = timestamps[1] - timestamps[0]
         else:
@@ -39,6 +43,9 @@ class Trace():
 
         self.bandwidths = [val if val >= 0.1 else 0.1 for val in bandwidths]
         self.delays = delays
+        # averages used for the reward on every step
+        self.mean_bandwidth = float(np.mean(self.bandwidths))
+        self.mean_delay = float(np.mean(self.delays))
         self.loss_rate = loss_rate
         self.queue_size = queue_size
         self.delay_noise = delay_noise
@@ -52,7 +59,7 @@ class Trace():
         self.return_noise = False
 
     def get_next_ts(self):
-        if self.idx + 1 < len(self.timestamps):
+        if self.idx + 1 < self._n_ts:
             return self.timestamps[self.idx+1]
         return 1e6
 
@@ -66,41 +73,71 @@ class Trace():
 
 
     def get_sending_t_usage(self, bits_2_send, ts):
-        cur_idx = copy.copy(self.idx)
+        # walk a local copy of the index, so self.idx is left untouched
+        timestamps = self.timestamps
+        bandwidths = self.bandwidths
+        n_ts = self._n_ts
+        idx = self.idx
         t_used = 0
 
         while bits_2_send > 0:
-            tmp_t_used = bits_2_send / (self.get_bandwidth(ts) * 1e6)
-            if self.idx + 1 < len(self.timestamps) and tmp_t_used + ts > self.timestamps[self.idx + 1]:
-                t_used += self.timestamps[self.idx + 1] - ts
-                bits_2_send -= (self.timestamps[self.idx + 1] - ts) * (self.get_bandwidth(ts) * 1e6)
-                ts = self.timestamps[self.idx + 1]
+            while idx + 1 < n_ts and timestamps[idx + 1] <= ts:
+                idx += 1
+            bw = (bandwidths[idx] if idx < len(bandwidths) else bandwidths[-1]) * 1e6
+            tmp_t_used = bits_2_send / bw
+            if idx + 1 < n_ts and tmp_t_used + ts > timestamps[idx + 1]:
+                t_used += timestamps[idx + 1] - ts
+                bits_2_send -= (timestamps[idx + 1] - ts) * bw
+                ts = timestamps[idx + 1]
             else:
                 t_used += tmp_t_used
-                bits_2_send -= tmp_t_used * (self.get_bandwidth(ts) * 1e6)
+                bits_2_send -= tmp_t_used * bw
                 ts += tmp_t_used
             bits_2_send = round(bits_2_send, 9)
-
-        self.idx = cur_idx # recover index
         return t_used
 
+    def _advance_idx(self, ts):
+        """Move self.idx forward to the last timestamp at or before ts.
+
+        Queries are mostly monotonic and close together, so the next slot is
+        checked first and longer jumps fall back to a binary search.
+        """
+        timestamps = self.timestamps
+        n_ts = self._n_ts
+        idx = self.idx + 1
+        if idx < n_ts and timestamps[idx] <= ts:
+            idx += 1
+            if idx < n_ts and timestamps[idx] <= ts:
+                idx = bisect_right(timestamps, ts, idx + 1)
+            self.idx = idx - 1
+
     def get_bandwidth(self, ts):
         """Return bandwidth(Mbps) at ts(second)."""
         # support time-variant bandwidth and constant bandwidth
-        while self.idx + 1 < len(self.timestamps) and self.timestamps[self.idx + 1] <= ts:
-            self.idx += 1
+        self._advance_idx(ts)
         if self.idx >= len(self.bandwidths):
             return self.bandwidths[-1]
         return self.bandwidths[self.idx]
 
     def get_delay(self, ts):
         """Return link one-way delay(millisecond) at ts(second)."""
-        while self.idx + 1 < len(self.timestamps) and self.timestamps[self.idx + 1] <= ts:
-            self.idx += 1
+        self._advance_idx(ts)
         if self.idx >= len(self.delays):
             return self.delays[-1]
         return self.delays[self.idx]
 
+    def get_bw_delay(self, ts):
+        """Return bandwidth(Mbps) and one-way delay(millisecond) at ts(second).
+
+        Same as get_bandwidth and get_delay, with a single index update.
+        """
+        self._advance_idx(ts)
+        idx = self.idx
+        bandwidths = self.bandwidths
+        delays = self.delays
+        return (bandwidths[idx] if idx < len(bandwidths) else bandwidths[-1],
+                delays[idx] if idx < len(delays) else delays[-1])
+
     def get_loss_rate(self):
         """Return link loss rate."""
         return self.loss_rate
@@ -113,7 +150,7 @@ class Trace():
         #     return 0
         if ts - self.noise_change_ts > 1 / cur_bw:
         # self.noise = max(0, np.random.uniform(0, self.delay_noise, 1).item())
-            self.noise = np.random.uniform(0, self.delay_noise, 1).item()
+            self.noise = np.random.uniform(0, self.delay_noise)
             self.noise_change_ts = ts
             ret =  self.noise
         else:
@@ -130,7 +167,7 @@ class Trace():
 
     def is_finished(self, ts):
         """Return if trace is finished."""
-        return ts >= self.timestamps[-1]
+        return ts >= self._duration
 
     def __str__(self):
         return ("Timestamps: {}s,\nBandwidth: {}Mbps,\nLink delay: {}ms,\n"
@@ -212,6 +249,76 @@ class Trace():
         return tr
 
 
+class ConstantTrace(Trace):
+    """Trace with a single bandwidth and delay for its whole duration.
+
+    Same behavior as Trace([duration], [bw], [delay], ...), without the index
+    bookkeeping on every lookup.
+    """
+
+    def __init__(self, duration: float, bandwidth: float, delay: float,
+                 loss_rate: float, queue_size: int, delay_noise: float = 0):
+        super().__init__([duration], [bandwidth], [delay], loss_rate,
+                         queue_size, delay_noise)
+        self._bw = self.bandwidths[0]
+        self._delay = delay
+
+    def get_avail_bits2send(self, lo_ts, up_ts):
+        bw = self._bw * 1e6
+        return -bw * (lo_ts - self._duration) + bw * (up_ts - self._duration)
+
+    def get_sending_t_usage(self, bits_2_send, ts):
+        bw = self._bw * 1e6
+        t_used = 0
+        while bits_2_send > 0:
+            tmp_t_used = bits_2_send / bw
+            t_used += tmp_t_used
+            bits_2_send = round(bits_2_send - tmp_t_used * bw, 9)
+        return t_used
+
+    def get_bandwidth(self, ts):
+        """Return bandwidth(Mbps) at ts(second)."""
+        return self._bw
+
+    def get_delay(self, ts):
+        """Return link one-way delay(millisecond) at ts(second)."""
+        return self._delay
+
+    def get_bw_delay(self, ts):
+        """Return bandwidth(Mbps) and one-way delay(millisecond) at ts(second)."""
+        return self._bw, self._delay
+
+
+def check_trace_ranges(duration_range: Tuple[float, float],
+                       bandwidth_range: Tuple[float, float],
+                       delay_range: Tuple[float, float],
+                       loss_rate_range: Tuple[float, float],
+                       queue_size_range: Tuple[int, int],
+                       T_s_range: Union[Tuple[float, float], None] = None,
+                       delay_noise_range: Union[Tuple[float, float], None] = None,
+                       constant_bw: bool = True):
+    """Assert the ranges passed to generate_trace are valid."""
+    assert len(
+        duration_range) == 2 and duration_range[0] <= duration_range[1]
+    assert len(
+        bandwidth_range) == 2 and bandwidth_range[0] <= bandwidth_range[1]
+    assert len(delay_range) == 2 and delay_range[0] <= delay_range[1]
+    assert len(
+        loss_rate_range) == 2 and loss_rate_range[0] <= loss_rate_range[1]
+    assert len(
+        queue_size_range) == 2 and queue_size_range[0] <= queue_size_range[1] + 1
+    if constant_bw:
+        return
+    # assert d_bw_range is not None and len(
+    #     d_bw_range) == 2 and d_bw_range[0] <= d_bw_range[1]
+    assert T_s_range is not None and len(
+        T_s_range) == 2 and T_s_range[0] <= T_s_range[1]
+    # assert d_delay_range is not None and len(
+    #     d_delay_range) == 2 and d_delay_range[0] <= d_delay_range[1]
+    assert delay_noise_range is not None and len(
+        delay_noise_range) == 2 and delay_noise_range[0] <= delay_noise_range[1]
+
+
 def generate_trace(duration_range: Tuple[float, float],
                    bandwidth_range: Tuple[float, float],
                    delay_range: Tuple[float, float],
@@ -221,7 +328,7 @@ def generate_trace(duration_range: Tuple[float, float],
                    d_delay_range: Union[Tuple[float, float], None] = None,
                    T_s_range: Union[Tuple[float, float], None] = None,
                    delay_noise_range: Union[Tuple[float, float], None] = None,
-                   constant_bw: bool = True):
+                   constant_bw: bool = True, check_ranges: bool = True):
     """Generate trace for a network flow.
 
     Args:
@@ -230,52 +337,39 @@ def generate_trace(duration_range: Tuple[float, float],
         delay_range: link one-way propagation delay in ms.
         loss_rate_range: Uplink loss rate range.
         queue_size_range: queue size range in packets.
+        check_ranges: validate the ranges, callers generating many traces
+            from the same ranges can check them once instead.
     """
-    assert len(
-        duration_range) == 2 and duration_range[0] <= duration_range[1]
-    assert len(
-        bandwidth_range) == 2 and bandwidth_range[0] <= bandwidth_range[1]
-    assert len(delay_range) == 2 and delay_range[0] <= delay_range[1]
-    assert len(
-        loss_rate_range) == 2 and loss_rate_range[0] <= loss_rate_range[1]
-    assert len(
-        queue_size_range) == 2 and queue_size_range[0] <= queue_size_range[1] + 1
-
-    delay = float(np.random.uniform(delay_range[0], delay_range[1], 1))
-    loss_rate = float(np.random.uniform(
-        loss_rate_range[0], loss_rate_range[1], 1))
+    if check_ranges:
+        check_trace_ranges(duration_range, bandwidth_range, delay_range,
+                           loss_rate_range, queue_size_range,
+                           T_s_range, delay_noise_range, constant_bw)
+
+    # scalar draws, without a size, return floats instead of 1-item arrays
+    delay = np.random.uniform(delay_range[0], delay_range[1])
+    loss_rate = np.random.uniform(loss_rate_range[0], loss_rate_range[1])
     # queue_size = int(np.random.randint(
     #     queue_size_range[0], queue_size_range[1]+1))
 
     queue_size = int(np.exp(np.random.uniform(
         np.log(queue_size_range[0]),
-        np.log(queue_size_range[1]+1), 1)))
+        np.log(queue_size_range[1]+1))))
 
     # if bandwidth_file:
     #     timestamps, bandwidths = load_bandwidth_from_file(bandwidth_file)
     #     return Trace(timestamps, bandwidths, delay, loss_rate, queue_size)
 
-    duration = float(np.random.uniform(
-        duration_range[0], duration_range[1], 1))
+    duration = np.random.uniform(duration_range[0], duration_range[1])
     if constant_bw:
-        bw = float(np.random.uniform(
-            bandwidth_range[0], bandwidth_range[1], 1))
-        ret_trace = Trace([duration], [bw], [delay], loss_rate, queue_size)
+        bw = np.random.uniform(bandwidth_range[0], bandwidth_range[1])
+        ret_trace = ConstantTrace(duration, bw, delay, loss_rate, queue_size)
         return ret_trace
 
     # use bandwidth generator.
-    # assert d_bw_range is not None and len(
-    #     d_bw_range) == 2 and d_bw_range[0] <= d_bw_range[1]
-    assert T_s_range is not None and len(
-        T_s_range) == 2 and T_s_range[0] <= T_s_range[1]
-    # assert d_delay_range is not None and len(
-    #     d_delay_range) == 2 and d_delay_range[0] <= d_delay_range[1]
-    assert delay_noise_range is not None and len(
-        delay_noise_range) == 2 and delay_noise_range[0] <= delay_noise_range[1]
     # d_bw = float(np.random.uniform(d_bw_range[0], d_bw_range[1], 1))
     # d_delay = float(np.random.uniform(d_delay_range[0], d_delay_range[1], 1))
-    T_s = float(np.random.uniform(T_s_range[0], T_s_range[1], 1))
-    delay_noise = float(np.random.uniform(delay_noise_range[0], delay_noise_range[1], 1))
+    T_s = np.random.uniform(T_s_range[0], T_s_range[1])
+    delay_noise = np.random.uniform(delay_noise_range[0], delay_noise_range[1])
 
     # timestamps, bandwidths = generate_bw_series(
     #     prob_stay, T_s, cov, duration, steps, bandwidth_range[0],
@@ -291,10 +385,47 @@ def generate_trace(duration_range: Tuple[float, float],
     return ret_trace
 
 
+def generate_constant_bw_traces(trace_cnt: int,
+                                duration_range: Tuple[float, float],
+                                bandwidth_range: Tuple[float, float],
+                                delay_range: Tuple[float, float],
+                                loss_rate_range: Tuple[float, float],
+                                queue_size_range: Tuple[int, int]):
+    """Generate trace_cnt constant bandwidth traces with one RNG call.
+
+    The traces are the same as trace_cnt calls of generate_trace with
+    constant_bw=True, since the samples are drawn in the same order and
+    scaled the same way as np.random.uniform does.
+    """
+    # columns follow the order generate_trace draws in
+    lows = np.array([delay_range[0], loss_rate_range[0],
+                     np.log(queue_size_range[0]), duration_range[0],
+                     bandwidth_range[0]])
+    highs = np.array([delay_range[1], loss_rate_range[1],
+                      np.log(queue_size_range[1]+1), duration_range[1],
+                      bandwidth_range[1]])
+    samples = lows + (highs - lows) * np.random.random_sample((trace_cnt, 5))
+    return [ConstantTrace(duration, bw, delay, loss_rate, int(np.exp(queue)))
+            for delay, loss_rate, queue, duration, bw in samples.tolist()]
+
+
+def generate_seeded_trace(seed: int, *args, **kwargs):
+    """Seed numpy and call generate_trace, used by generate_traces workers."""
+    np.random.seed(seed)
+    return generate_trace(*args, **kwargs)
+
+
 def generate_traces(config_file: str, tot_trace_cnt: int, duration: int,
-                    constant_bw: bool = True):
+                    constant_bw: bool = True, n_proc: int = 1):
+    """Generate tot_trace_cnt traces from the env configs in config_file.
+
+    Time variant traces are generated by n_proc processes if n_proc > 1.
+    Each trace then gets its own seed drawn from np.random, so the traces
+    are still reproducible by set_seed but differ from a serial run.
+    """
     config = read_json_file(config_file)
     traces = []
+    trace_args = []
     weight_sum = 0
     for env_config in config:
         weight_sum += env_config['weight']
@@ -316,31 +447,39 @@ def generate_traces(config_file: str, tot_trace_cnt: int, duration: int,
         delay_noise_min, delay_noise_max = env_config['delay_noise'] if 'delay_noise' in env_config else (0, 0)
         T_s_min, T_s_max = env_config['T_s'] if 'T_s' in env_config else (1, 1)
         trace_cnt = int(round(env_config['weight'] * tot_trace_cnt))
-        for _ in range(trace_cnt):
-            trace = generate_trace((duration_min, duration_max),
-                                   (bw_min, bw_max),
-                                   (delay_min, delay_max),
-                                   (loss_min, loss_max),
-                                   (queue_min, queue_max),
-                                   (d_bw_min, d_bw_max),
-                                   (d_delay_min, d_delay_max),
-                                   (T_s_min, T_s_max),
-                                   (delay_noise_min, delay_noise_max),
-                                   constant_bw=constant_bw)
-            traces.append(trace)
+        check_trace_ranges((duration_min, duration_max), (bw_min, bw_max),
+                           (delay_min, delay_max), (loss_min, loss_max),
+                           (queue_min, queue_max), (T_s_min, T_s_max),
+                           (delay_noise_min, delay_noise_max), constant_bw)
+        if constant_bw:
+            traces += generate_constant_bw_traces(
+                trace_cnt, (duration_min, duration_max), (bw_min, bw_max),
+                (delay_min, delay_max), (loss_min, loss_max),
+                (queue_min, queue_max))
+            continue
+        trace_args += [((duration_min, duration_max), (bw_min, bw_max),
+                        (delay_min, delay_max), (loss_min, loss_max),
+                        (queue_min, queue_max), (d_bw_min, d_bw_max),
+                        (d_delay_min, d_delay_max), (T_s_min, T_s_max),
+                        (delay_noise_min, delay_noise_max), constant_bw,
+                        False)
+                       for _ in range(trace_cnt)]
+    if n_proc <= 1 or len(trace_args) <= 1:
+        return traces + [generate_trace(*args) for args in trace_args]
+    seeds = np.random.randint(0, 2**31 - 1, len(trace_args)).tolist()
+    with mp.Pool(processes=min(n_proc, len(trace_args))) as pool:
+        traces += pool.starmap(
+            generate_seeded_trace,
+            [(seed, *args) for seed, args in zip(seeds, trace_args)])
     return traces
 
 
 def load_bandwidth_from_file(filename: str):
-    timestamps = []
-    bandwidths = []
     with open(filename, 'r') as f:
-        csv_reader = csv.DictReader(f, delimiter=',')
-        for row in csv_reader:
-            timestamps.append(float(row['Timestamp']))
-            bandwidths.append(float(row['Bandwidth']))
-
-    return timestamps, bandwidths
+        header = next(csv.reader(f, delimiter=','))
+        cols = (header.index('Timestamp'), header.index('Bandwidth'))
+        data = np.loadtxt(f, delimiter=',', usecols=cols, ndmin=2)
+    return data[:, 0].tolist(), data[:, 1].tolist()
 
 
 def generate_bw_series(prob_stay: float, T_s: float, cov: float, duration: float,
@@ -368,18 +507,17 @@ def generate_bw_series(prob_stay: float, T_s: float, cov: float, duration: float
     switch_parameter = np.real(np.roots(coeffs)[0])
     """Generate a bandwidth series."""
     # get bandwidth levels (in Mbps)
-    bw_states = []
-    curr = min_bw
-    for _ in range(0, steps):
-        bw_states.append(curr)
-        curr += (max_bw-min_bw)/(steps-1)
+    bw_states = np.linspace(min_bw, max_bw, steps).tolist()
 
     # list of transition probabilities
-    transition_probs = []
     # assume you can go steps-1 states away (we will normalize this to the
     # actual scenario)
-    for z in range(1, steps-1):
-        transition_probs.append(1/(switch_parameter**z))
+    transition_probs = (
+        1 / switch_parameter ** np.arange(1, steps - 1)).tolist()
+    # cumulative normalized transition probabilities for every possible max
+    # distance, so transition does not rebuild them on each step
+    transition_cdfs = [transition_cdf(transition_probs[0:max_distance])
+                       for max_distance in range(len(bw_states))]
 
     # takes a state and decides what the next state is
     current_state = np.random.randint(0, len(bw_states)-1)
@@ -392,7 +530,7 @@ def generate_bw_series(prob_stay: float, T_s: float, cov: float, duration: float
     while ts < duration:
         # prints timestamp (in seconds) and throughput (in Mbits/s)
         if cnt <= 0:
-            noise = np.random.normal(0, current_variance, 1)[0]
+            noise = np.random.normal(0, current_variance)
             cnt = T_s
         # the gaussian val is at least 0.1
         gaus_val = max(0.1, bw_states[current_state] + noise)
@@ -400,7 +538,7 @@ def generate_bw_series(prob_stay: float, T_s: float, cov: float, duration: float
         trace_bw.append(gaus_val)
         cnt -= 1
         next_val = transition(current_state, prob_stay, bw_states,
-                              transition_probs)
+                              transition_cdfs)
         if current_state != next_val:
             cnt = 0
         current_state = next_val
@@ -409,8 +547,17 @@ def generate_bw_series(prob_stay: float, T_s: float, cov: float, duration: float
     return trace_time, trace_bw
 
 
-def transition(state, prob_stay, bw_states, transition_probs):
-    """Hidden Markov State transition."""
+def transition_cdf(transition_probs):
+    """Running sums of the normalized transition probabilities."""
+    trans_sum = sum(transition_probs)
+    return list(accumulate(x / trans_sum for x in transition_probs))
+
+
+def transition(state, prob_stay, bw_states, transition_cdfs):
+    """Hidden Markov State transition.
+
+    transition_cdfs[d] is transition_cdf(transition_probs[0:d]).
+    """
     # variance_switch_prob, sigma_low, sigma_high,
     transition_prob = np.random.uniform()
 
@@ -421,37 +568,23 @@ def transition(state, prob_stay, bw_states, transition_probs):
         curr_pos = state
         # first find max distance that you can be from current state
         max_distance = max(curr_pos, len(bw_states)-1-curr_pos)
-        # cut the transition probabilities to only have possible number of
+        # the transition probabilities cut to only have possible number of
         # steps
-        curr_transition_probs = transition_probs[0:max_distance]
-        trans_sum = sum(curr_transition_probs)
-        normalized_trans = [x/trans_sum for x in curr_transition_probs]
+        curr_transition_cdf = transition_cdfs[max_distance]
         # generate a random number and see which bin it falls in to
         trans_switch_val = np.random.uniform()
-        running_sum = 0
-        num_switches = -1
-        for ind in range(0, len(normalized_trans)):
-            # this is the val
-            if (trans_switch_val <= (normalized_trans[ind] + running_sum)):
-                num_switches = ind
-                break
-            else:
-                running_sum += normalized_trans[ind]
+        num_switches = bisect_left(curr_transition_cdf, trans_switch_val)
+        if num_switches == len(curr_transition_cdf):
+            num_switches = -1
 
         # now check if there are multiple ways to move this many states away
         switch_up = curr_pos + num_switches
         switch_down = curr_pos - num_switches
-        # can go either way
-        if (switch_down >= 0 and switch_up <= (len(bw_states)-1)):
-            x = np.random.uniform(0, 1, 1)
-            if (x < 0.5):
-                return switch_up
-            else:
-                return switch_down
-        elif switch_down >= 0:  # switch down
-            return switch_down
-        else:  # switch up
-            return switch_up
+        up_ok = switch_up <= len(bw_states) - 1
+        down_ok = switch_down >= 0
+        if up_ok and down_ok:  # can go either way
+            return switch_up if np.random.uniform() < 0.5 else switch_down
+        return switch_down if down_ok else switch_up
 
 
 def parse_args():
@@ -577,35 +710,49 @@ def main():
 
 def generate_bw_delay_series(T_s: float, duration: float, min_tp: float, max_tp: float,
                              min_delay: float, max_delay: float):
-    timestamps = []
-    bandwidths = []
-    delays = []
     round_digit = 5
 
-    bw_val = round(np.exp(float(np.random.uniform(
-        np.log(min_tp), np.log(max_tp), 1))), round_digit)
-    delay_val = round(float(np.random.uniform(
-        min_delay, max_delay, 1)), round_digit)
-    ts = 0
-    bw_change_ts = 0
-    delay_change_ts = 0
+    bw_val = round(np.exp(np.random.uniform(
+        np.log(min_tp), np.log(max_tp))), round_digit)
+    delay_val = round(np.random.uniform(min_delay, max_delay), round_digit)
+
+    # the series is sampled every 0.1s. step_ts are the step times, as
+    # compared against duration and T_s, and timestamps their rounded values
+    n_steps = max(int(duration * 10) + 2, 1)
+    timestamps = np.arange(n_steps) / 10
+    step_ts = np.concatenate([[0], timestamps[:-1] + 0.1])
+    n_steps = int(np.count_nonzero(step_ts < duration))
+    step_ts = step_ts[:n_steps]
+    timestamps = timestamps[:n_steps]
+
+    # find the steps where bandwidth changes, i.e. the first step at least
+    # T_s after the previous change
+    change_idxs = []
+    if T_s != 0:
+        bw_change_ts = 0
+        start = 0
+        while start < n_steps:
+            idx = int(np.searchsorted(step_ts, bw_change_ts + T_s))
+            idx = min(max(idx, start), n_steps)
+            while idx > start and step_ts[idx - 1] - bw_change_ts >= T_s:
+                idx -= 1
+            while idx < n_steps and step_ts[idx] - bw_change_ts < T_s:
+                idx += 1
+            if idx >= n_steps:
+                break
+            change_idxs.append(idx)
+            bw_change_ts = step_ts[idx]
+            start = idx + 1
 
-    while ts < duration:
-        if T_s !=0 and ts - bw_change_ts >= T_s:
-            bw_val = float(np.random.uniform(min_tp, max_tp, 1))
-            bw_change_ts = ts
-
-        ts = round(ts, round_digit)
-        timestamps.append(ts)
-        bandwidths.append(bw_val)
-        delays.append(delay_val)
-        ts += 0.1
-    timestamps.append(round(duration, round_digit))
-    bandwidths.append(bw_val)
-    delays.append(delay_val)
+    # draw every new bandwidth at once, then hold each until the next change
+    bw_vals = [bw_val] + np.random.uniform(min_tp, max_tp, len(change_idxs)).tolist()
+    bandwidths = np.repeat(bw_vals, np.diff([0] + change_idxs + [n_steps]))
 
-    return timestamps, bandwidths, delays
+    timestamps = timestamps.tolist() + [round(duration, round_digit)]
+    bandwidths = bandwidths.tolist() + [bw_vals[-1]]
+    delays = [delay_val] * len(timestamps)
 
+    return timestamps, bandwidths, delays
 
 if __name__ == "__main__":
     main()
@@ -82,7 +82,7 @@ class RandomizationRanges():
         return self.rand_ranges
 
     def dump(self, filename):
-        write_json_file(filename, self.rand_ranges)
+        write_json_file(filename, self.rand_ranges, indent=4)
 
 
 def map_log_to_lin(x):